@@ -0,0 +1,83 @@
+# Cache of finished-game pages, used by SwehockeyDownloaderMiddleware.
+#
+# Once a game has ended its Game/Events and Game/LineUps pages never
+# change, so they are kept forever. Pages are stored in one sqlite file:
+#
+#     blobs(hash, body)                  zlib compressed page bodies,
+#                                        keyed by the sha1 of the body
+#     pages(kind, key, hash, encoding)   kind and key as in corpus.py
+#
+# Pages are looked up by kind and swehockey id rather than by URL, so
+# a cache filled from the real site also serves a crawl of the mock
+# server (see mockserver.py), and identical bodies are only stored once.
+
+import hashlib
+import sqlite3
+import zlib
+
+# Commit to the cache file every N stored pages.
+COMMIT_EVERY = 100
+
+
+class SqliteBlobStorage:
+    def __init__(self, path, commit_every=COMMIT_EVERY):
+        self.path = path
+        self.commit_every = commit_every
+        self.uncommitted = 0
+        self.con = sqlite3.connect(path)
+        self.con.execute("PRAGMA journal_mode=WAL")
+        self.con.execute(
+            """CREATE TABLE IF NOT EXISTS blobs(
+                hash TEXT PRIMARY KEY,
+                body BLOB NOT NULL
+            )"""
+        )
+        self.con.execute(
+            """CREATE TABLE IF NOT EXISTS pages(
+                kind TEXT NOT NULL,
+                key TEXT NOT NULL,
+                hash TEXT NOT NULL REFERENCES blobs(hash),
+                encoding TEXT NOT NULL,
+                PRIMARY KEY(kind, key)
+            )"""
+        )
+        self.con.commit()
+
+    def __len__(self):
+        return self.con.execute("SELECT COUNT(*) FROM pages").fetchone()[0]
+
+    def retrieve(self, kind, key):
+        # Return (body, encoding) of a cached page, or None.
+        row = self.con.execute(
+            """SELECT blobs.body, pages.encoding FROM pages
+            JOIN blobs ON blobs.hash = pages.hash
+            WHERE pages.kind = ? AND pages.key = ?""",
+            (kind, key),
+        ).fetchone()
+        if row is None:
+            return None
+        return zlib.decompress(row[0]), row[1]
+
+    def store(self, kind, key, body, encoding):
+        digest = hashlib.sha1(body).hexdigest()
+        self.con.execute(
+            "INSERT OR IGNORE INTO blobs(hash, body) VALUES(?, ?)",
+            (digest, zlib.compress(body)),
+        )
+        self.con.execute(
+            "INSERT OR REPLACE INTO pages(kind, key, hash, encoding) VALUES(?, ?, ?, ?)",
+            (kind, key, digest, encoding),
+        )
+        self.uncommitted += 1
+        if self.uncommitted >= self.commit_every:
+            self.con.commit()
+            self.uncommitted = 0
+
+    def keys(self, kind):
+        # Keys (swehockey ids) of the cached pages of one kind.
+        rows = self.con.execute("SELECT key FROM pages WHERE kind = ?", (kind,))
+        return [row[0] for row in rows]
+
+    def close(self):
+        self.con.commit()
+        self.con.close()
@@ -0,0 +1,17 @@
+# Custom scrapy commands for the swehockey project.
+#
+# Enabled through the COMMANDS_MODULE setting, run with
+# $ scrapy <command> from the swehockey dir.
+
+from scrapy.crawler import Crawler
+from scrapy.utils.misc import load_object
+
+
+def offline_spider(spidercls, settings):
+    # A spider for running the callbacks on stored pages, outside of a
+    # crawl. The crawler only gets its stats collector when a crawl
+    # starts (on newer Scrapy, reading crawler.stats before that
+    # raises), so give it one here for the stats the callbacks keep.
+    crawler = Crawler(spidercls, settings)
+    crawler.stats = load_object(crawler.settings["STATS_CLASS"])(crawler)
+    return spidercls.from_crawler(crawler)
@@ -0,0 +1,107 @@
+import resource
+import sys
+import time
+from collections import defaultdict
+
+from scrapy.commands import ScrapyCommand
+from scrapy.exceptions import UsageError
+
+from swehockey.commands import offline_spider
+from swehockey.corpus import Corpus
+from swehockey.items import BasicStatsItem
+from swehockey.spiders.stats import StatsSpider
+
+
+def timed(func, name, totals):
+    # Wrap a spider callback so that the time spent in it, including
+    # consuming its output, is added to totals[name].
+    def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        result = func(*args, **kwargs)
+        if hasattr(result, "__next__"):
+            result = list(result)
+        totals[name] += time.perf_counter() - start
+        return result
+
+    return wrapper
+
+
+class Command(ScrapyCommand):
+    requires_project = True
+    default_settings = {"LOG_LEVEL": "ERROR"}
+
+    def syntax(self):
+        return "[options] <corpus dir>"
+
+    def short_desc(self):
+        return "Benchmark the spider callbacks on a recorded corpus"
+
+    def add_options(self, parser):
+        super().add_options(parser)
+        parser.add_argument(
+            "-n",
+            "--repeat",
+            type=int,
+            default=3,
+            help="number of passes over the corpus (default: 3)",
+        )
+
+    def run(self, args, opts):
+        if len(args) != 1:
+            raise UsageError()
+        corpus = Corpus(args[0])
+        if not len(corpus):
+            raise UsageError(f"No pages in corpus {args[0]}")
+
+        spider = offline_spider(StatsSpider, self.settings)
+        totals = defaultdict(float)
+        # parse_game_actions is called from parse_stats_summary, so
+        # its time is also included in the time of that callback.
+        for name in (
+            "parse",
+            "parse_schedule",
+            "parse_stats_summary",
+            "parse_game_actions",
+            "parse_line_up",
+        ):
+            setattr(spider, name, timed(getattr(spider, name), name, totals))
+
+        # Decompress everything up front, so only parsing is measured.
+        pages = [
+            (entry, corpus.read(entry)) for entry in corpus.entries()
+        ]
+        for _ in range(opts.repeat):
+            # Parse the games of the date pages again on every pass.
+            spider.scheduled_games.clear()
+            for entry, body in pages:
+                response = corpus.response(entry, body)
+                swehockey_id = entry["key"]
+                item = BasicStatsItem(swehockey_id=swehockey_id)
+                if entry["kind"] == "date":
+                    spider.parse(response)
+                elif entry["kind"] == "schedule":
+                    spider.parse_schedule(response, schedule=swehockey_id)
+                elif entry["kind"] == "events":
+                    spider.parse_stats_summary(
+                        response, swehockey_id=swehockey_id, item=item
+                    )
+                elif entry["kind"] == "lineups":
+                    spider.parse_line_up(
+                        response, swehockey_id=swehockey_id, item=item
+                    )
+
+        total = sum(
+            t for name, t in totals.items() if name != "parse_game_actions"
+        )
+        count = len(pages) * opts.repeat
+        print(f"{len(pages)} pages x {opts.repeat} passes")
+        for name, t in totals.items():
+            print(f"  {name:<22}{t:9.3f} s")
+        print(f"  {'total':<22}{total:9.3f} s")
+        print(f"{count / total:.1f} pages/sec")
+
+        # ru_maxrss is in kilobytes on Linux and bytes on macOS.
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        if sys.platform != "darwin":
+            peak *= 1024
+        print(f"peak memory {peak / 2**20:.1f} MiB")
@@ -0,0 +1,68 @@
+import gzip
+import os
+
+from scrapy.commands import ScrapyCommand
+from scrapy.exceptions import UsageError
+from scrapy.http import HtmlResponse
+
+from swehockey.parsers import parse_event_rows
+from swehockey.spiders.stats import StatsSpider
+from swehockey.xpaths import XPATHS, nodes
+
+
+def find_pages(paths):
+    # Yield every saved page (.html or .html.gz) in the given
+    # files and directories.
+    for path in paths:
+        if os.path.isdir(path):
+            for root, dirs, files in os.walk(path):
+                for name in sorted(files):
+                    if name.endswith((".html", ".html.gz")):
+                        yield os.path.join(root, name)
+        else:
+            yield path
+
+
+def read_page(path):
+    opener = gzip.open if path.endswith(".gz") else open
+    with opener(path, "rb") as f:
+        return f.read()
+
+
+class Command(ScrapyCommand):
+    requires_project = True
+    default_settings = {"LOG_ENABLED": False}
+
+    def syntax(self):
+        return "<page or directory> [...]"
+
+    def short_desc(self):
+        return "Check that FAST_EVENT_PARSER gives the same game events as the item loaders"
+
+    def run(self, args, opts):
+        if not args:
+            raise UsageError()
+
+        spider = StatsSpider()
+        pages = mismatches = 0
+        for path in find_pages(args):
+            response = HtmlResponse(
+                url=f"file://{os.path.abspath(path)}", body=read_page(path)
+            )
+            events = nodes(response.selector, XPATHS["events_table"])
+            actions = nodes(events, XPATHS["event_rows"])
+
+            expected = [spider.load_game_event(a) for a in actions]
+            result = parse_event_rows(a.root for a in actions)
+            pages += 1
+            if result != expected:
+                mismatches += 1
+                print(f"MISMATCH {path}")
+                for row, (a, b) in enumerate(zip(expected, result)):
+                    if a != b:
+                        print(f"  row {row}:\n    loader: {a}\n    fast:   {b}")
+                if len(expected) != len(result):
+                    print(f"  {len(expected)} != {len(result)} rows")
+
+        print(f"{pages} pages checked, {mismatches} mismatches")
+        self.exitcode = 1 if mismatches else 0
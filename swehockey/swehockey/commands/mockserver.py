@@ -0,0 +1,58 @@
+from scrapy.commands import ScrapyCommand
+from scrapy.exceptions import UsageError
+
+from swehockey.corpus import Corpus
+from swehockey.mockserver import make_site
+
+
+class Command(ScrapyCommand):
+    requires_project = True
+
+    def syntax(self):
+        return "[options] <corpus dir>"
+
+    def short_desc(self):
+        return "Serve a recorded corpus as a local mock of stats.swehockey.se"
+
+    def add_options(self, parser):
+        super().add_options(parser)
+        parser.add_argument(
+            "--port", type=int, default=8080, help="default: 8080"
+        )
+        parser.add_argument(
+            "--latency",
+            type=float,
+            default=0.0,
+            help="seconds before each response (default: 0)",
+        )
+        parser.add_argument(
+            "--jitter",
+            type=float,
+            default=0.0,
+            help="random +/- seconds added to the latency (default: 0)",
+        )
+        parser.add_argument(
+            "--error-rate",
+            type=float,
+            default=0.0,
+            help="fraction of requests answered with 503 (default: 0)",
+        )
+
+    def run(self, args, opts):
+        from twisted.internet import reactor
+
+        if len(args) != 1:
+            raise UsageError()
+        corpus = Corpus(args[0])
+        site = make_site(
+            corpus,
+            latency=opts.latency,
+            jitter=opts.jitter,
+            error_rate=opts.error_rate,
+        )
+        reactor.listenTCP(opts.port, site, interface="127.0.0.1")
+        print(
+            f"Serving {len(corpus)} pages on http://127.0.0.1:{opts.port}, "
+            f"crawl with: scrapy crawl stats -a base_url=http://127.0.0.1:{opts.port}"
+        )
+        reactor.run()
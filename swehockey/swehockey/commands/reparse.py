@@ -0,0 +1,159 @@
+import logging
+import multiprocessing
+import os
+import time
+
+from scrapy.commands import ScrapyCommand
+from scrapy.exceptions import UsageError
+from scrapy.http import HtmlResponse
+from scrapy.settings import Settings
+from twisted.internet import defer, threads
+
+from swehockey.cache import SqliteBlobStorage
+from swehockey.commands import offline_spider
+from swehockey.corpus import Corpus
+from swehockey.items import BasicStatsItem
+from swehockey.pipelines import (
+    BATCH_GAMES,
+    BATCH_SECONDS,
+    QUEUE_SIZE,
+    SwehockeyPipeline,
+)
+from swehockey.spiders.stats import StatsSpider
+
+# Games sent to a worker process at a time.
+CHUNKSIZE = 16
+
+# Set up in each worker process by init_worker().
+source = None
+spider = None
+
+
+def open_source(path):
+    # Stored pages are read either from a corpus directory (see
+    # corpus.py) or from a game page cache file (see cache.py).
+    if os.path.isdir(path):
+        return Corpus(path)
+    return SqliteBlobStorage(path)
+
+
+def init_worker(path, settings):
+    global source, spider
+    source = open_source(path)
+    spider = offline_spider(StatsSpider, Settings(settings))
+
+
+def page_response(kind, url, swehockey_id):
+    page = source.retrieve(kind, swehockey_id)
+    if page is None:
+        return None
+    body, encoding = page
+    return HtmlResponse(url=url, body=body, encoding=encoding)
+
+
+def parse_game(swehockey_id):
+    # Run the spider callbacks on the stored events and line up pages
+    # of one game, as the crawl would have. Returns the game item, or
+    # None if a page is missing or the game did not finish.
+    event_url = f"{spider.base_url}/Game/Events/{swehockey_id}"
+    line_up_url = f"{spider.base_url}/Game/LineUps/{swehockey_id}"
+    events = page_response("events", event_url, swehockey_id)
+    lineups = page_response("lineups", line_up_url, swehockey_id)
+    if events is None or lineups is None:
+        return None
+
+    item = BasicStatsItem(
+        swehockey_id=swehockey_id, event_url=event_url, line_up_url=line_up_url
+    )
+    try:
+        list(spider.parse_stats_summary(events, swehockey_id=swehockey_id, item=item))
+        for item in spider.parse_line_up(lineups, swehockey_id=swehockey_id):
+            return item
+    except Exception:
+        logging.exception(f"Failed to parse game {swehockey_id}")
+    finally:
+        spider.pending_games.pop(swehockey_id, None)
+    return None
+
+
+class Command(ScrapyCommand):
+    requires_project = True
+    default_settings = {"LOG_LEVEL": "WARNING"}
+
+    def syntax(self):
+        return "[options] <corpus dir or cache file> <database>"
+
+    def short_desc(self):
+        return "Rebuild a database from stored pages, without crawling"
+
+    def add_options(self, parser):
+        super().add_options(parser)
+        parser.add_argument(
+            "-j",
+            "--processes",
+            type=int,
+            default=os.cpu_count(),
+            help="number of worker processes (default: number of cores)",
+        )
+
+    def run(self, args, opts):
+        from twisted.internet import reactor
+
+        if len(args) != 2:
+            raise UsageError()
+        path, db_path = args
+        if not os.path.exists(path):
+            raise UsageError(f"No such corpus or cache: {path}")
+        # Rows already in the database are never replaced, so
+        # re-parsed games must go to a new database.
+        if os.path.exists(db_path):
+            raise UsageError(f"Database {db_path} already exists")
+
+        settings = self.settings.copy_to_dict()
+        game_ids = sorted(open_source(path).keys("events"), key=int)
+        pipeline = SwehockeyPipeline(
+            db_path=db_path,
+            batch_games=self.settings.getint("SQLITE_BATCH_GAMES", BATCH_GAMES),
+            batch_seconds=self.settings.getfloat(
+                "SQLITE_BATCH_SECONDS", BATCH_SECONDS
+            ),
+            queue_size=self.settings.getint("SQLITE_QUEUE_SIZE", QUEUE_SIZE),
+        )
+        pool = multiprocessing.Pool(
+            opts.processes, initializer=init_worker, initargs=(path, settings)
+        )
+        start = time.perf_counter()
+        d = self.reparse(pool, game_ids, pipeline)
+
+        def done(games):
+            seconds = time.perf_counter() - start
+            print(
+                f"{games} of {len(game_ids)} games stored in {db_path} "
+                f"in {seconds:.1f} s"
+            )
+
+        d.addCallback(done)
+        d.addErrback(lambda failure: failure.printTraceback())
+        d.addBoth(lambda _: pool.terminate())
+        d.addBoth(lambda _: reactor.stop())
+        reactor.run()
+
+    @defer.inlineCallbacks
+    def reparse(self, pool, game_ids, pipeline):
+        # Items are parsed by the pool and stored in game id order.
+        # Waiting for the next item happens off the reactor thread, so
+        # the pipeline's writer thread is never held up.
+        results = pool.imap(parse_game, game_ids, chunksize=CHUNKSIZE)
+        pipeline.open_spider(None)
+        games = 0
+        try:
+            while True:
+                item = yield threads.deferToThread(next, results, StopIteration)
+                if item is StopIteration:
+                    break
+                if item is not None:
+                    yield pipeline.process_item(item, None)
+                    games += 1
+        finally:
+            yield pipeline.close_spider(None)
+        return games
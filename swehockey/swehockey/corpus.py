@@ -0,0 +1,146 @@
+# Offline corpus of recorded stats.swehockey.se pages.
+#
+# A corpus is a directory with one gzip'd file per page and a
+# manifest.json describing them:
+#
+#     corpus/
+#         manifest.json
+#         date/2014-01-01.html.gz
+#         events/123456.html.gz
+#         lineups/123456.html.gz
+#         schedule/3905.html.gz
+#
+# The manifest has the format
+#
+#     {"version": 1, "pages": [{"url": ..., "kind": ..., "key": ...,
+#       "file": ..., "status": ..., "encoding": ...}, ...]}
+#
+# where kind is one of PAGE_KINDS and key is the date (for date pages),
+# swehockey id (for game pages) or schedule id (for schedule pages). Corpora are recorded with
+# CorpusRecorderMiddleware, by setting CORPUS_RECORD_DIR.
+
+import gzip
+import hashlib
+import json
+import os
+import re
+
+from scrapy.http import HtmlResponse
+
+MANIFEST = "manifest.json"
+VERSION = 1
+
+# URL patterns of the pages the spider downloads, by kind.
+PAGE_KINDS = {
+    "date": re.compile(r"/GamesByDate/([\d-]+)"),
+    "events": re.compile(r"/Game/Events/(\d+)"),
+    "lineups": re.compile(r"/Game/LineUps/(\d+)"),
+    "schedule": re.compile(r"/ScheduleAndResults/Schedule/(\d+)"),
+}
+
+
+def page_kind(url):
+    # Return the kind of page and its key (date or swehockey id),
+    # or (None, None) for any other URL.
+    for kind, pattern in PAGE_KINDS.items():
+        match = pattern.search(url)
+        if match:
+            return kind, match.group(1)
+    return None, None
+
+
+def page_hash(body):
+    # Hash of a page body, ignoring all whitespace, so that changes in
+    # indentation or line breaks do not count as changes of the page.
+    body = b"".join(body.split())
+    return hashlib.blake2b(body, digest_size=16).hexdigest()
+
+
+class Corpus:
+    def __init__(self, path):
+        self.path = path
+        # Manifest entries by URL.
+        self.pages = {}
+        manifest = os.path.join(path, MANIFEST)
+        if os.path.exists(manifest):
+            with open(manifest, encoding="utf-8") as f:
+                data = json.load(f)
+            if data["version"] != VERSION:
+                raise ValueError(
+                    f"Unsupported corpus version {data['version']} in {manifest}"
+                )
+            self.pages = {page["url"]: page for page in data["pages"]}
+        # The same entries by (kind, key). Pages recorded from several
+        # hosts (see mockserver.py) share a key, the last one wins.
+        self.pages_by_key = {
+            (page["kind"], page["key"]): page for page in self.pages.values()
+        }
+
+    def __len__(self):
+        return len(self.pages)
+
+    def add(self, url, body, encoding="utf-8", status=200):
+        # Store a page, replacing any earlier version of it.
+        kind, key = page_kind(url)
+        if kind is None:
+            raise ValueError(f"Not a swehockey page: {url}")
+        file = f"{kind}/{key}.html.gz"
+        os.makedirs(os.path.join(self.path, kind), exist_ok=True)
+        with gzip.open(os.path.join(self.path, file), "wb") as f:
+            f.write(body)
+        page = {
+            "url": url,
+            "kind": kind,
+            "key": key,
+            "file": file,
+            "status": status,
+            "encoding": encoding,
+        }
+        self.pages[url] = page
+        self.pages_by_key[(kind, key)] = page
+
+    def save(self):
+        # Write the manifest. Written to a temporary file first, so
+        # that an interrupted save never leaves a broken manifest.
+        os.makedirs(self.path, exist_ok=True)
+        manifest = os.path.join(self.path, MANIFEST)
+        with open(manifest + ".tmp", "w", encoding="utf-8") as f:
+            json.dump(
+                {"version": VERSION, "pages": list(self.pages.values())},
+                f,
+                indent=1,
+            )
+        os.replace(manifest + ".tmp", manifest)
+
+    def entries(self, kind=None):
+        # Manifest entries, optionally only those of one kind.
+        return [
+            page
+            for page in self.pages.values()
+            if kind is None or page["kind"] == kind
+        ]
+
+    def keys(self, kind):
+        # Keys (dates or swehockey ids) of the pages of one kind.
+        return [k for page_kind, k in self.pages_by_key if page_kind == kind]
+
+    def retrieve(self, kind, key):
+        # Return (body, encoding) of a page, or None. Same interface
+        # as the game page cache (see cache.py).
+        page = self.pages_by_key.get((kind, key))
+        if page is None:
+            return None
+        return self.read(page), page["encoding"]
+
+    def read(self, entry):
+        with gzip.open(os.path.join(self.path, entry["file"]), "rb") as f:
+            return f.read()
+
+    def response(self, entry, body=None):
+        # Build the response the spider would have received for the page.
+        return HtmlResponse(
+            url=entry["url"],
+            status=entry["status"],
+            body=self.read(entry) if body is None else body,
+            encoding=entry["encoding"],
+        )
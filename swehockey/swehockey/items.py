@@ -8,11 +8,14 @@ import logging
 from scrapy.loader import ItemLoader
 from itemloaders.processors import TakeFirst, MapCompose, Identity, Compose
 from itemloaders.utils import arg_to_iter
+from lxml import etree
 from itemadapter import ItemAdapter
 from w3lib.html import remove_tags
 from dataclasses import dataclass, field
 import re
 
+from swehockey.xpaths import values
+
 
 def clean(text=""):
     # Remove all extra whitespace in a string.
@@ -194,29 +197,53 @@ class BasicStatsItem(scrapy.Item):
     lineup = scrapy.Field()
 
 
-class EventItem(scrapy.Item):
-    time = scrapy.Field()
-    event = scrapy.Field()
-    team = scrapy.Field()
-    player = scrapy.Field(
-        input_processor=MapCompose(clean, parse_player),
-    )
-    assist_1 = scrapy.Field(
-        input_processor=MapCompose(clean, parse_player),
-    )
-    assist_2 = scrapy.Field(
-        input_processor=MapCompose(clean, parse_player),
+class LiveGameItem(BasicStatsItem):
+    # Update of a game in progress (see LIVE_CRAWL): the current game
+    # summary and all of its game events so far. Has no line up.
+    pass
+
+
+# The game events, shootout attempts and lines of a game are kept as
+# slotted dataclasses rather than scrapy.Items, since there are dozens
+# of them per game and they are held until the line up is parsed.
+# Unset fields are "" like those of the item loader. The field
+# processors are in the metadata, so EventItemLoader can still fill
+# them. The pipelines read their attributes directly.
+
+
+def processed(*processors, default=""):
+    # A record field with the given input processor.
+    return field(
+        default=default, metadata={"input_processor": MapCompose(*processors)}
     )
 
-    details_1 = scrapy.Field(input_processor=MapCompose(clean, parse_event_detail))
-    details_2 = scrapy.Field(input_processor=MapCompose(clean, parse_event_detail))
 
-class ShootoutItem(scrapy.Item):
-    scored = scrapy.Field()
-    score = scrapy.Field()
-    team = scrapy.Field()
-    player = scrapy.Field(input_processor=MapCompose(clean, parse_player))
-    goalie = scrapy.Field(input_processor=MapCompose(clean, (lambda text: text.replace("vs. goalie ", "")), parse_player))
+@dataclass(slots=True)
+class EventItem:
+    time: str = ""
+    event: str = ""
+    team: str = ""
+    # [NUM, LAST_NAME, FIRST_NAME] lists, see parse_player.
+    player: list = processed(clean, parse_player)
+    assist_1: list = processed(clean, parse_player)
+    assist_2: list = processed(clean, parse_player)
+    # Dicts, see parse_event_detail.
+    details_1: dict = processed(clean, parse_event_detail)
+    details_2: dict = processed(clean, parse_event_detail)
+
+
+def strip_goalie_prefix(text):
+    return text.replace("vs. goalie ", "")
+
+
+@dataclass(slots=True)
+class ShootoutItem:
+    scored: str = ""
+    score: str = ""
+    team: str = ""
+    player: list = processed(clean, parse_player)
+    goalie: list = processed(clean, strip_goalie_prefix, parse_player)
+
 
 class LineupItem(scrapy.Item):
     refs = scrapy.Field(input_processor=MapCompose(separate_names, clean), output_processor=Identity())
@@ -228,11 +255,17 @@ class LineupItem(scrapy.Item):
     starting_players_lineup_home = scrapy.Field(input_processor=MapCompose(clean, parse_player), output_processor=Identity())
     starting_players_lineup_away = scrapy.Field(input_processor=MapCompose(clean, parse_player), output_processor=Identity())
 
-class LineItem(scrapy.Item):
-    line_name = scrapy.Field()
-    players = scrapy.Field(input_processor=MapCompose(clean, parse_player), output_processor=Identity())
-    # line_row_1 = scrapy.Field()
-    # line_row_2 = scrapy.Field()
+@dataclass(slots=True)
+class LineItem:
+    line_name: str = ""
+    players: list = field(
+        default="",
+        metadata={
+            "input_processor": MapCompose(clean, parse_player),
+            "output_processor": Identity(),
+        },
+    )
+
 
 class EventItemLoader(ItemLoader):
 
@@ -245,6 +278,18 @@ class EventItemLoader(ItemLoader):
         self._values.setdefault(field_name, [])
         self._values[field_name] += arg_to_iter(processed_value)
 
+    def _get_xpathvalues(self, xpaths, *args, **kw):
+        # Evaluate precompiled XPaths (see xpaths.py) directly with lxml,
+        # instead of letting parsel compile the expression again.
+        xpaths = arg_to_iter(xpaths)
+        if all(isinstance(xpath, etree.XPath) for xpath in xpaths):
+            return [
+                value
+                for xpath in xpaths
+                for value in values(self.selector, xpath)
+            ]
+        return super()._get_xpathvalues(xpaths, *args, **kw)
+
     def load_item(self):
         adapter = ItemAdapter(self.item)
         for field_name in tuple(self._values):
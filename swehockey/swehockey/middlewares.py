@@ -3,11 +3,27 @@
 # See documentation in:
 # https://docs.scrapy.org/en/latest/topics/spider-middleware.html
 
+import logging
+import os
+import statistics
+from collections import deque
+from urllib.parse import urlsplit
+
 from scrapy import signals
+from scrapy.exceptions import NotConfigured
+from scrapy.http import HtmlResponse
+from scrapy.utils.misc import load_object
 
 # useful for handling different item types with a single interface
 from itemadapter import is_item, ItemAdapter
 
+from twisted.internet import task
+
+from swehockey.corpus import Corpus, page_hash, page_kind
+from swehockey.pipelines import DB_PATH, load_page_hashes
+from swehockey.profiling import Timer, prometheus_text, profile_stats
+from swehockey.signals import game_finished
+
 
 class SwehockeySpiderMiddleware:
     # Not all methods need to be defined. If a method is not defined,
@@ -56,48 +72,426 @@ class SwehockeySpiderMiddleware:
         spider.logger.info('Spider opened: %s' % spider.name)
 
 
+class ProfilingMiddleware(SwehockeySpiderMiddleware):
+    # The project spider middleware, profiling the crawl: record the
+    # wall and CPU time of every spider callback in the crawler stats
+    # (see profiling.py). The spider adds parse_game_actions, which
+    # parse_stats_summary calls directly and whose time is therefore
+    # also included in that of parse_stats_summary, and the pipelines
+    # add their insert_* methods and rows written per table (see
+    # RowPipeline.profile).
+    #
+    # Logs the 10 slowest every PROFILE_INTERVAL seconds and, if
+    # PROFILE_PROMETHEUS_FILE is set, writes the numbers to that file
+    # for the node_exporter textfile collector. Enabled by setting PROFILE.
+
+    def __init__(self, stats, interval=60.0, prometheus_file=None):
+        self.stats = stats
+        self.interval = interval
+        self.prometheus_file = prometheus_file
+        self.task = None
+        self.items = 0
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        if not crawler.settings.getbool("PROFILE"):
+            raise NotConfigured
+        s = cls(
+            crawler.stats,
+            interval=crawler.settings.getfloat("PROFILE_INTERVAL", 60.0),
+            prometheus_file=crawler.settings.get("PROFILE_PROMETHEUS_FILE"),
+        )
+        crawler.signals.connect(s.spider_opened, signal=signals.spider_opened)
+        crawler.signals.connect(s.spider_closed, signal=signals.spider_closed)
+        return s
+
+    def callback_name(self, response):
+        callback = response.request.callback if response.request else None
+        return getattr(callback, "__name__", "parse")
+
+    def process_spider_output(self, response, result, spider):
+        # The callback runs while its output is iterated, so time
+        # each step of the iteration, but not what happens to the
+        # output further down the middleware chain.
+        timer = Timer()
+        result = iter(result)
+        try:
+            while True:
+                timer.start()
+                try:
+                    i = next(result)
+                except StopIteration:
+                    break
+                finally:
+                    timer.stop()
+                yield i
+        finally:
+            timer.record(self.stats, self.callback_name(response))
+
+    async def process_spider_output_async(self, response, result, spider):
+        timer = Timer()
+        result = result.__aiter__()
+        try:
+            while True:
+                timer.start()
+                try:
+                    i = await result.__anext__()
+                except StopAsyncIteration:
+                    break
+                finally:
+                    timer.stop()
+                yield i
+        finally:
+            timer.record(self.stats, self.callback_name(response))
+
+    def spider_opened(self, spider):
+        super().spider_opened(spider)
+        self.task = task.LoopingCall(self.log)
+        self.task.start(self.interval, now=False)
+
+    def spider_closed(self, spider):
+        if self.task and self.task.running:
+            self.task.stop()
+        self.log()
+
+    def log(self):
+        items = self.stats.get_value("item_scraped_count", 0)
+        rate = (items - self.items) * 60 / self.interval
+        self.items = items
+        profile = sorted(
+            profile_stats(self.stats).items(),
+            key=lambda entry: entry[1].get("wall_seconds", 0),
+            reverse=True,
+        )
+        timings = ", ".join(
+            f"{name} {values.get('wall_seconds', 0):.2f}s/{values.get('cpu_seconds', 0):.2f}s cpu"
+            f" ({values.get('calls', 0)} calls)"
+            for name, values in profile[:10]
+        )
+        logging.info(f"Profile: {items} items ({rate:.1f} items/min). {timings}")
+        if self.prometheus_file:
+            # Written to a temporary file first, so that the collector
+            # never reads a half written file.
+            with open(self.prometheus_file + ".tmp", "w") as f:
+                f.write(prometheus_text(self.stats))
+            os.replace(self.prometheus_file + ".tmp", self.prometheus_file)
+
+
 class SwehockeyDownloaderMiddleware:
-    # Not all methods need to be defined. If a method is not defined,
-    # scrapy acts as if the downloader middleware does not modify the
-    # passed objects.
+    # Serve finished-game pages from a cache (see cache.py) instead of
+    # downloading them again. Date pages and pages of unfinished games
+    # are never cached, so they are always fetched from the site.
+    # Enabled by setting GAME_CACHE_PATH.
+    #
+    # The spider sends the game_finished signal for the events page of
+    # every game that passes the game ended check, and for its line up
+    # page once both are parsed. Only those pages are stored.
+
+    def __init__(self, storage, stats):
+        self.storage = storage
+        self.stats = stats
 
     @classmethod
     def from_crawler(cls, crawler):
-        # This method is used by Scrapy to create your spiders.
-        s = cls()
+        path = crawler.settings.get("GAME_CACHE_PATH")
+        if not path:
+            raise NotConfigured
+        storage_class = load_object(
+            crawler.settings.get(
+                "GAME_CACHE_STORAGE", "swehockey.cache.SqliteBlobStorage"
+            )
+        )
+        s = cls(storage_class(path), crawler.stats)
         crawler.signals.connect(s.spider_opened, signal=signals.spider_opened)
+        crawler.signals.connect(s.spider_closed, signal=signals.spider_closed)
+        crawler.signals.connect(s.game_finished, signal=game_finished)
+        return s
+
+    def process_request(self, request, spider):
+        kind, key = page_kind(request.url)
+        if request.method != "GET" or kind not in ("events", "lineups"):
+            return None
+        cached = self.storage.retrieve(kind, key)
+        if cached is None:
+            self.stats.inc_value("game_cache/miss")
+            return None
+        self.stats.inc_value("game_cache/hit")
+        body, encoding = cached
+        return HtmlResponse(
+            url=request.url,
+            body=body,
+            encoding=encoding,
+            request=request,
+            flags=["cached"],
+        )
+
+    def game_finished(self, response):
+        self.store(response)
+
+    def store(self, response):
+        kind, key = page_kind(response.url)
+        if (
+            kind in ("events", "lineups")
+            and response.status == 200
+            and "cached" not in response.flags
+        ):
+            self.storage.store(kind, key, response.body, response.encoding)
+            self.stats.inc_value("game_cache/store")
+
+    def spider_opened(self, spider):
+        spider.logger.info(
+            f"Game page cache {self.storage.path}: {len(self.storage)} pages"
+        )
+
+    def spider_closed(self, spider):
+        self.storage.close()
+
+
+class PolitenessBudget:
+    # Concurrency and delay of one download slot, adjusted after every
+    # `window` responses. While the median latency stays close to the
+    # lowest seen (the baseline) and there are few errors, the delay is
+    # halved down to min_delay and then concurrency is raised by one at
+    # a time. When the site slows down (latency above slowdown times
+    # the baseline) or errors, concurrency is halved, and once it is 1
+    # the delay is doubled instead. The baseline is a low percentile of
+    # the latencies in the last `history` windows, never below
+    # min_baseline, so a single very fast response does not make every
+    # normal one look slow.
+
+    def __init__(
+        self,
+        max_concurrency,
+        min_delay=0.0,
+        max_delay=30.0,
+        window=10,
+        slowdown=1.5,
+        max_error_rate=0.02,
+        min_baseline=0.01,
+        history=10,
+        percentile=10,
+    ):
+        self.max_concurrency = max_concurrency
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+        self.window = window
+        self.slowdown = slowdown
+        self.max_error_rate = max_error_rate
+        self.min_baseline = min_baseline
+        self.percentile = percentile
+        self.concurrency = 1
+        self.delay = min_delay
+        self.baseline = None
+        self.latencies = []
+        self.recent = deque(maxlen=window * history)
+        self.errors = 0
+
+    def observe(self, latency=None, error=False):
+        # Record one response (or failed download). Returns a
+        # description of the adjustment made, if any.
+        if error:
+            self.errors += 1
+        else:
+            self.latencies.append(latency)
+            self.recent.append(latency)
+        if len(self.latencies) + self.errors < self.window:
+            return None
+
+        error_rate = self.errors / (len(self.latencies) + self.errors)
+        latency = statistics.median(self.latencies) if self.latencies else None
+        self.latencies = []
+        self.errors = 0
+        if latency is not None:
+            recent = sorted(self.recent)
+            self.baseline = max(
+                recent[len(recent) * self.percentile // 100], self.min_baseline
+            )
+
+        old = (self.concurrency, self.delay)
+        if error_rate > self.max_error_rate or (
+            latency is not None and latency > self.baseline * self.slowdown
+        ):
+            if self.concurrency > 1:
+                self.concurrency //= 2
+            else:
+                self.delay = min(max(self.delay * 2, 0.25), self.max_delay)
+        elif self.delay > self.min_delay:
+            self.delay = self.delay / 2 if self.delay / 2 >= 0.25 else self.min_delay
+        elif self.concurrency < self.max_concurrency:
+            self.concurrency += 1
+        if (self.concurrency, self.delay) == old:
+            return None
+        latency_text = "n/a" if latency is None else f"{latency:.2f}s"
+        return (
+            f"concurrency {old[0]} -> {self.concurrency}, "
+            f"delay {old[1]:.2f}s -> {self.delay:.2f}s "
+            f"(median latency {latency_text}, baseline {self.baseline or 0:.2f}s, "
+            f"errors {error_rate:.0%})"
+        )
+
+
+class PolitenessMiddleware:
+    # Adjust the concurrency and delay of the download slots from the
+    # observed latency and error rate (see PolitenessBudget), instead of
+    # fixed CONCURRENT_REQUESTS_PER_DOMAIN and DOWNLOAD_DELAY settings.
+    # Date (and schedule) pages and game pages are downloaded in
+    # separate slots with their own budgets, POLITENESS_DATE_CONCURRENCY and
+    # POLITENESS_GAME_CONCURRENCY at most. Every adjustment is logged.
+    # Enabled by setting POLITENESS_ENABLED. Do not combine with
+    # AutoThrottle, which also sets the slot delays.
+
+    def __init__(self, crawler):
+        self.crawler = crawler
+        settings = crawler.settings
+        self.max_concurrency = {
+            "date": settings.getint("POLITENESS_DATE_CONCURRENCY", 4),
+            "game": settings.getint("POLITENESS_GAME_CONCURRENCY", 16),
+        }
+        self.budget_settings = {
+            "min_delay": settings.getfloat("DOWNLOAD_DELAY"),
+            "max_delay": settings.getfloat("POLITENESS_MAX_DELAY", 30.0),
+            "window": settings.getint("POLITENESS_WINDOW", 10),
+            "slowdown": settings.getfloat("POLITENESS_SLOWDOWN", 1.5),
+            "max_error_rate": settings.getfloat("POLITENESS_MAX_ERROR_RATE", 0.02),
+            "min_baseline": settings.getfloat("POLITENESS_MIN_BASELINE", 0.01),
+        }
+        # Budgets by download slot.
+        self.budgets = {}
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        if not crawler.settings.getbool("POLITENESS_ENABLED"):
+            raise NotConfigured
+        s = cls(crawler)
+        crawler.signals.connect(
+            s.request_reached_downloader, signal=signals.request_reached_downloader
+        )
         return s
 
+    def budget(self, request):
+        key = request.meta.get("download_slot")
+        kind = request.meta.get("politeness_budget")
+        if key is None or kind is None:
+            return None, None
+        if key not in self.budgets:
+            self.budgets[key] = PolitenessBudget(
+                self.max_concurrency[kind], **self.budget_settings
+            )
+        return key, self.budgets[key]
+
+    def apply(self, key, budget):
+        slot = self.crawler.engine.downloader.slots.get(key)
+        if slot is not None:
+            slot.concurrency = budget.concurrency
+            slot.delay = budget.delay
+
     def process_request(self, request, spider):
-        # Called for each request that goes through the downloader
-        # middleware.
-
-        # Must either:
-        # - return None: continue processing this request
-        # - or return a Response object
-        # - or return a Request object
-        # - or raise IgnoreRequest: process_exception() methods of
-        #   installed downloader middleware will be called
+        kind = page_kind(request.url)[0]
+        if kind is None or "download_slot" in request.meta:
+            return None
+        kind = "game" if kind in ("events", "lineups") else "date"
+        request.meta["politeness_budget"] = kind
+        request.meta["download_slot"] = f"{urlsplit(request.url).hostname}/{kind}"
         return None
 
-    def process_response(self, request, response, spider):
-        # Called with the response returned from the downloader.
+    def request_reached_downloader(self, request, spider):
+        # Sent once the downloader has looked up the slot of the request,
+        # or created it (on its first request, or after dropping it when
+        # idle), before the slot sends anything. So the slot runs at the
+        # budget's concurrency and delay from the start, not the defaults.
+        key, budget = self.budget(request)
+        if budget is not None:
+            self.apply(key, budget)
 
-        # Must either;
-        # - return a Response object
-        # - return a Request object
-        # - or raise IgnoreRequest
+    def process_response(self, request, response, spider):
+        latency = request.meta.get("download_latency")
+        if "cached" in response.flags or latency is None:
+            return response
+        error = response.status >= 500 or response.status == 429
+        self.observe(request, latency=latency, error=error)
         return response
 
     def process_exception(self, request, exception, spider):
-        # Called when a download handler or a process_request()
-        # (from other downloader middleware) raises an exception.
+        self.observe(request, error=True)
 
-        # Must either:
-        # - return None: continue processing this exception
-        # - return a Response object: stops process_exception() chain
-        # - return a Request object: stops process_exception() chain
-        pass
+    def observe(self, request, latency=None, error=False):
+        key, budget = self.budget(request)
+        if budget is None:
+            return
+        decision = budget.observe(latency=latency, error=error)
+        if decision:
+            logging.info(f"Politeness {key}: {decision}")
+            stats = self.crawler.stats
+            stats.set_value(f"politeness/{key}/concurrency", budget.concurrency)
+            stats.set_value(f"politeness/{key}/delay", budget.delay)
+            self.apply(key, budget)
 
-    def spider_opened(self, spider):
-        spider.logger.info('Spider opened: %s' % spider.name)
+
+class CorpusRecorderMiddleware:
+    # Save every downloaded swehockey page to an offline corpus
+    # (see corpus.py), for benchmarking the parsers without network.
+    # Enabled by setting CORPUS_RECORD_DIR.
+
+    def __init__(self, path):
+        self.corpus = Corpus(path)
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        path = crawler.settings.get("CORPUS_RECORD_DIR")
+        if not path:
+            raise NotConfigured
+        s = cls(path)
+        crawler.signals.connect(s.spider_closed, signal=signals.spider_closed)
+        return s
+
+    def process_response(self, request, response, spider):
+        if response.status == 200 and page_kind(response.url)[0]:
+            self.corpus.add(
+                response.url, response.body, encoding=response.encoding
+            )
+        return response
+
+    def spider_closed(self, spider):
+        self.corpus.save()
+        spider.logger.info(
+            f"Saved {len(self.corpus)} pages to corpus {self.corpus.path}"
+        )
+
+
+class PageHashMiddleware:
+    # Flag game pages that have not changed since their game was stored,
+    # so that no parsing or database work is done for them. The body
+    # hash (see corpus.page_hash) of an events or line up page is
+    # compared to the one in the page_hashes table, recorded by
+    # SwehockeyPipeline, and if they match the response gets the
+    # "unchanged" flag. The spider drops the game if its other page is
+    # unchanged too, and otherwise parses the unchanged page after all,
+    # so that the game is stored again. Enabled by setting
+    # PAGE_HASH_SKIP.
+
+    def __init__(self, hashes, stats):
+        self.hashes = hashes
+        self.stats = stats
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        if not crawler.settings.getbool("PAGE_HASH_SKIP"):
+            raise NotConfigured
+        db_path = crawler.settings.get("SQLITE_DB_PATH", DB_PATH)
+        s = cls(load_page_hashes(db_path), crawler.stats)
+        logging.info(f"Page hashes of {len(s.hashes)} stored game pages loaded.")
+        return s
+
+    def process_response(self, request, response, spider):
+        if response.status != 200:
+            return response
+        if page_kind(response.url)[0] not in ("events", "lineups"):
+            return response
+        stored = self.hashes.get(urlsplit(response.url).path)
+        if stored is None:
+            return response
+        if page_hash(response.body) != stored:
+            self.stats.inc_value("page_hash/changed")
+            return response
+        self.stats.inc_value("page_hash/hits")
+        return response.replace(flags=response.flags + ["unchanged"])
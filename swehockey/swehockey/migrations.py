@@ -0,0 +1,577 @@
+# Versioned schema of the sqlite database written by SwehockeyPipeline.
+#
+# The schema version of a database is kept in PRAGMA user_version.
+# MIGRATIONS[n] upgrades a database from version n to version n + 1,
+# and migrate() runs every migration a database has not seen yet, each
+# in its own transaction. Databases created before the schema was
+# versioned have version 0, so they are upgraded in place as well.
+#
+# Never edit a migration once it has been released, add a new one.
+
+import logging
+
+# Version 1: the tables as originally created by the pipeline.
+# IF NOT EXISTS, since unversioned databases already have them.
+CREATE_TABLES = """
+CREATE TABLE IF NOT EXISTS games(
+    id INTEGER PRIMARY KEY,
+    swehockey_id INTEGER UNIQUE,
+    date TEXT,
+    arena TEXT,
+    score_home INTEGER,
+    score_away INTEGER,
+    home_name TEXT,
+    home_name_abbrev TEXT,
+    away_name TEXT,
+    away_name_abbrev TEXT,
+    event_url TEXT,
+    league TEXT,
+    line_up_url TEXT,
+    pim_total_team_1 INTEGER,
+    pim_total_team_2 INTEGER,
+    pp_perc_team_1 REAL,
+    pp_perc_team_2 REAL,
+    pp_time_team_1 TEXT,
+    pp_time_team_2 TEXT,
+    saves_total_team_1 INTEGER,
+    saves_total_team_2 INTEGER,
+    shots_total_team_1 INTEGER,
+    shots_total_team_2 INTEGER,
+    spectators INTEGER
+);
+CREATE TABLE IF NOT EXISTS lines(
+    swehockey_id INTEGER,
+    team TEXT,
+    line_name TEXT,
+    player_first_name TEXT,
+    player_last_name TEXT,
+    player_number INTEGER,
+    starting INTEGER,
+    UNIQUE (swehockey_id, team, line_name, player_first_name, player_last_name, player_number, starting) ON CONFLICT IGNORE
+);
+CREATE TABLE IF NOT EXISTS refs(
+    swehockey_id INTEGER,
+    ref_name TEXT,
+    position TEXT,
+    UNIQUE (swehockey_id, ref_name, position) ON CONFLICT IGNORE
+);
+CREATE TABLE IF NOT EXISTS stats_by_period(
+    swehockey_id INTEGER,
+    team_name TEXT,
+    stat_name TEXT,
+    period INTEGER,
+    stat INTEGER,
+    UNIQUE (swehockey_id, team_name, stat_name, period, stat) ON CONFLICT IGNORE
+);
+CREATE TABLE IF NOT EXISTS goalie_stats(
+    swehockey_id INTEGER,
+    team_name TEXT,
+    first_name TEXT,
+    last_name TEXT,
+    player_number INTEGER,
+    saves INTEGER,
+    shots INTEGER,
+    UNIQUE (swehockey_id, team_name, player_number, saves, shots) ON CONFLICT IGNORE
+);
+CREATE TABLE IF NOT EXISTS plus_minus(
+    event_id INTEGER,
+    swehockey_id INTEGER,
+    side TEXT,
+    num INTEGER,
+    UNIQUE (event_id, swehockey_id, side, num) ON CONFLICT IGNORE
+);
+CREATE TABLE IF NOT EXISTS game_events(
+    id INTEGER PRIMARY KEY,
+    swehockey_id INTEGER,
+    time TEXT,
+    team TEXT,
+    event TEXT,
+    player_first_name TEXT,
+    player_last_name TEXT,
+    player_number INTEGER,
+    assist_1_first_name TEXT,
+    assist_1_last_name TEXT,
+    assist_1_number INTEGER,
+    assist_2_first_name TEXT,
+    assist_2_last_name TEXT,
+    assist_2_number INTEGER,
+    type TEXT,
+    penalty_type TEXT,
+    penalty_start_time TEXT,
+    penalty_end_time TEXT,
+    ps_outcome TEXT,
+    ps_goalie_number INTEGER,
+    UNIQUE (swehockey_id, time, team, event, player_number, assist_1_number, assist_2_number, type, penalty_type, penalty_start_time, penalty_end_time, ps_outcome, ps_goalie_number) ON CONFLICT IGNORE
+);
+CREATE TABLE IF NOT EXISTS shootouts(
+    swehockey_id INTEGER,
+    scored TEXT,
+    score TEXT,
+    team TEXT,
+    player_first_name TEXT,
+    player_last_name TEXT,
+    player_number INTEGER,
+    goalie_first_name TEXT,
+    goalie_last_name TEXT,
+    goalie_number INTEGER,
+    UNIQUE (swehockey_id, scored, score, team, player_number, goalie_number) ON CONFLICT IGNORE
+);
+CREATE TABLE IF NOT EXISTS checkpoints(
+    kind TEXT,
+    key TEXT,
+    UNIQUE (kind, key) ON CONFLICT IGNORE
+);
+"""
+
+# Version 2: narrow natural keys instead of UNIQUE constraints over
+# (almost) every column, and indexes for lookups by game, player,
+# team and date. Game events and shootout attempts are keyed by their
+# position (seq, starting at 1) in the game, numbered in insertion
+# order for existing rows. Changing a constraint means rebuilding the
+# table in sqlite. Rows that only differed outside the new keys are
+# merged, keeping the first one.
+NARROW_KEYS = """
+CREATE TABLE lines_new(
+    swehockey_id INTEGER,
+    team TEXT,
+    line_name TEXT,
+    player_first_name TEXT,
+    player_last_name TEXT,
+    player_number INTEGER,
+    starting INTEGER,
+    UNIQUE (swehockey_id, team, line_name, player_number) ON CONFLICT IGNORE
+);
+INSERT INTO lines_new SELECT * FROM lines ORDER BY rowid;
+DROP TABLE lines;
+ALTER TABLE lines_new RENAME TO lines;
+
+CREATE TABLE stats_by_period_new(
+    swehockey_id INTEGER,
+    team_name TEXT,
+    stat_name TEXT,
+    period INTEGER,
+    stat INTEGER,
+    UNIQUE (swehockey_id, team_name, stat_name, period) ON CONFLICT IGNORE
+);
+INSERT INTO stats_by_period_new SELECT * FROM stats_by_period ORDER BY rowid;
+DROP TABLE stats_by_period;
+ALTER TABLE stats_by_period_new RENAME TO stats_by_period;
+
+CREATE TABLE goalie_stats_new(
+    swehockey_id INTEGER,
+    team_name TEXT,
+    first_name TEXT,
+    last_name TEXT,
+    player_number INTEGER,
+    saves INTEGER,
+    shots INTEGER,
+    UNIQUE (swehockey_id, team_name, player_number) ON CONFLICT IGNORE
+);
+INSERT INTO goalie_stats_new SELECT * FROM goalie_stats ORDER BY rowid;
+DROP TABLE goalie_stats;
+ALTER TABLE goalie_stats_new RENAME TO goalie_stats;
+
+CREATE TABLE plus_minus_new(
+    event_id INTEGER,
+    swehockey_id INTEGER,
+    side TEXT,
+    num INTEGER,
+    UNIQUE (event_id, side, num) ON CONFLICT IGNORE
+);
+INSERT INTO plus_minus_new SELECT * FROM plus_minus ORDER BY rowid;
+DROP TABLE plus_minus;
+ALTER TABLE plus_minus_new RENAME TO plus_minus;
+
+CREATE TABLE game_events_new(
+    id INTEGER PRIMARY KEY,
+    swehockey_id INTEGER,
+    seq INTEGER,
+    time TEXT,
+    team TEXT,
+    event TEXT,
+    player_first_name TEXT,
+    player_last_name TEXT,
+    player_number INTEGER,
+    assist_1_first_name TEXT,
+    assist_1_last_name TEXT,
+    assist_1_number INTEGER,
+    assist_2_first_name TEXT,
+    assist_2_last_name TEXT,
+    assist_2_number INTEGER,
+    type TEXT,
+    penalty_type TEXT,
+    penalty_start_time TEXT,
+    penalty_end_time TEXT,
+    ps_outcome TEXT,
+    ps_goalie_number INTEGER,
+    UNIQUE (swehockey_id, seq) ON CONFLICT IGNORE
+);
+INSERT INTO game_events_new SELECT
+    id, swehockey_id,
+    ROW_NUMBER() OVER (PARTITION BY swehockey_id ORDER BY id),
+    time, team, event,
+    player_first_name, player_last_name, player_number,
+    assist_1_first_name, assist_1_last_name, assist_1_number,
+    assist_2_first_name, assist_2_last_name, assist_2_number,
+    type, penalty_type, penalty_start_time, penalty_end_time,
+    ps_outcome, ps_goalie_number
+FROM game_events;
+DROP TABLE game_events;
+ALTER TABLE game_events_new RENAME TO game_events;
+
+CREATE TABLE shootouts_new(
+    swehockey_id INTEGER,
+    seq INTEGER,
+    scored TEXT,
+    score TEXT,
+    team TEXT,
+    player_first_name TEXT,
+    player_last_name TEXT,
+    player_number INTEGER,
+    goalie_first_name TEXT,
+    goalie_last_name TEXT,
+    goalie_number INTEGER,
+    UNIQUE (swehockey_id, seq) ON CONFLICT IGNORE
+);
+INSERT INTO shootouts_new SELECT
+    swehockey_id,
+    ROW_NUMBER() OVER (PARTITION BY swehockey_id ORDER BY rowid),
+    scored, score, team,
+    player_first_name, player_last_name, player_number,
+    goalie_first_name, goalie_last_name, goalie_number
+FROM shootouts;
+DROP TABLE shootouts;
+ALTER TABLE shootouts_new RENAME TO shootouts;
+
+-- Lookups by game are served by the keys above, which all start
+-- with swehockey_id (or event_id for plus_minus).
+CREATE INDEX games_date ON games(date, league);
+CREATE INDEX games_home_name ON games(home_name, date);
+CREATE INDEX games_away_name ON games(away_name, date);
+CREATE INDEX lines_player ON lines(player_last_name, player_first_name, player_number);
+CREATE INDEX lines_team ON lines(team, swehockey_id);
+CREATE INDEX refs_ref_name ON refs(ref_name);
+CREATE INDEX stats_by_period_team_name ON stats_by_period(team_name, stat_name);
+CREATE INDEX goalie_stats_player ON goalie_stats(last_name, first_name, player_number);
+CREATE INDEX goalie_stats_team_name ON goalie_stats(team_name);
+CREATE INDEX plus_minus_swehockey_id ON plus_minus(swehockey_id, num);
+CREATE INDEX game_events_player ON game_events(player_last_name, player_first_name, player_number);
+CREATE INDEX game_events_player_number ON game_events(swehockey_id, team, player_number);
+CREATE INDEX game_events_team ON game_events(team, type);
+CREATE INDEX shootouts_player ON shootouts(player_last_name, player_first_name, player_number);
+"""
+
+# Version 3: leagues, teams and players dimension tables with integer
+# ids, referred to by the fact tables instead of repeating names.
+# A team is a (name, abbrev) pair and a player a (first name, last
+# name, number, team) tuple, as printed on the game pages. Existing
+# rows are converted using game_teams, the team ids of the strings
+# used for the home and away teams of each game: names, abbrevs and
+# the "lineup_*" / "*_team_coaches" values of lines.team.
+DIMENSIONS = """
+CREATE TABLE leagues(
+    id INTEGER PRIMARY KEY,
+    name TEXT,
+    UNIQUE (name) ON CONFLICT IGNORE
+);
+CREATE TABLE teams(
+    id INTEGER PRIMARY KEY,
+    name TEXT,
+    abbrev TEXT,
+    UNIQUE (name, abbrev) ON CONFLICT IGNORE
+);
+CREATE TABLE players(
+    id INTEGER PRIMARY KEY,
+    first_name TEXT,
+    last_name TEXT,
+    number INTEGER,
+    team_id INTEGER REFERENCES teams(id),
+    UNIQUE (first_name, last_name, number, team_id) ON CONFLICT IGNORE
+);
+CREATE INDEX players_name ON players(last_name, first_name);
+CREATE INDEX players_team_id ON players(team_id, number);
+
+INSERT INTO leagues(name)
+    SELECT league FROM games WHERE league IS NOT NULL ORDER BY id;
+INSERT INTO teams(name, abbrev)
+    SELECT name, abbrev FROM (
+        SELECT id, 0 AS side, home_name AS name, home_name_abbrev AS abbrev FROM games
+        UNION ALL
+        SELECT id, 1, away_name, away_name_abbrev FROM games
+    ) WHERE name IS NOT NULL ORDER BY id, side;
+
+CREATE TEMP TABLE game_teams(
+    swehockey_id INTEGER,
+    key TEXT,
+    team_id INTEGER,
+    opponent_id INTEGER,
+    PRIMARY KEY (swehockey_id, key) ON CONFLICT IGNORE
+);
+CREATE TEMP TABLE game_sides AS
+    SELECT g.swehockey_id, g.home_name, g.home_name_abbrev, g.away_name,
+        g.away_name_abbrev, h.id AS home_id, a.id AS away_id
+    FROM games g
+    JOIN teams h ON h.name IS g.home_name AND h.abbrev IS g.home_name_abbrev
+    JOIN teams a ON a.name IS g.away_name AND a.abbrev IS g.away_name_abbrev;
+INSERT INTO game_teams SELECT swehockey_id, home_name, home_id, away_id FROM game_sides;
+INSERT INTO game_teams SELECT swehockey_id, home_name_abbrev, home_id, away_id FROM game_sides;
+INSERT INTO game_teams SELECT swehockey_id, 'lineup_home', home_id, away_id FROM game_sides;
+INSERT INTO game_teams SELECT swehockey_id, 'home_team_coaches', home_id, away_id FROM game_sides;
+INSERT INTO game_teams SELECT swehockey_id, away_name, away_id, home_id FROM game_sides;
+INSERT INTO game_teams SELECT swehockey_id, away_name_abbrev, away_id, home_id FROM game_sides;
+INSERT INTO game_teams SELECT swehockey_id, 'lineup_away', away_id, home_id FROM game_sides;
+INSERT INTO game_teams SELECT swehockey_id, 'away_team_coaches', away_id, home_id FROM game_sides;
+
+INSERT INTO players(first_name, last_name, number, team_id)
+    SELECT l.player_first_name, l.player_last_name, l.player_number, gt.team_id
+    FROM lines l LEFT JOIN game_teams gt
+        ON gt.swehockey_id = l.swehockey_id AND gt.key = l.team
+    ORDER BY l.rowid;
+INSERT INTO players(first_name, last_name, number, team_id)
+    SELECT s.first_name, s.last_name, s.player_number, gt.team_id
+    FROM goalie_stats s LEFT JOIN game_teams gt
+        ON gt.swehockey_id = s.swehockey_id AND gt.key = s.team_name
+    ORDER BY s.rowid;
+INSERT INTO players(first_name, last_name, number, team_id)
+    SELECT first_name, last_name, number, team_id FROM (
+        SELECT e.id, 0 AS n, e.player_first_name AS first_name,
+            e.player_last_name AS last_name, e.player_number AS number,
+            gt.team_id
+        FROM game_events e LEFT JOIN game_teams gt
+            ON gt.swehockey_id = e.swehockey_id AND gt.key = e.team
+        WHERE e.player_last_name IS NOT NULL
+        UNION ALL
+        SELECT e.id, 1, e.assist_1_first_name, e.assist_1_last_name,
+            e.assist_1_number, gt.team_id
+        FROM game_events e LEFT JOIN game_teams gt
+            ON gt.swehockey_id = e.swehockey_id AND gt.key = e.team
+        WHERE e.assist_1_last_name IS NOT NULL
+        UNION ALL
+        SELECT e.id, 2, e.assist_2_first_name, e.assist_2_last_name,
+            e.assist_2_number, gt.team_id
+        FROM game_events e LEFT JOIN game_teams gt
+            ON gt.swehockey_id = e.swehockey_id AND gt.key = e.team
+        WHERE e.assist_2_last_name IS NOT NULL
+    ) ORDER BY id, n;
+INSERT INTO players(first_name, last_name, number, team_id)
+    SELECT first_name, last_name, number, team_id FROM (
+        SELECT s.rowid AS r, 0 AS n, s.player_first_name AS first_name,
+            s.player_last_name AS last_name, s.player_number AS number,
+            gt.team_id
+        FROM shootouts s LEFT JOIN game_teams gt
+            ON gt.swehockey_id = s.swehockey_id AND gt.key = s.team
+        UNION ALL
+        SELECT s.rowid, 1, s.goalie_first_name, s.goalie_last_name,
+            s.goalie_number, gt.opponent_id
+        FROM shootouts s LEFT JOIN game_teams gt
+            ON gt.swehockey_id = s.swehockey_id AND gt.key = s.team
+    ) ORDER BY r, n;
+
+CREATE TABLE games_new(
+    id INTEGER PRIMARY KEY,
+    swehockey_id INTEGER UNIQUE,
+    date TEXT,
+    arena TEXT,
+    score_home INTEGER,
+    score_away INTEGER,
+    home_team_id INTEGER REFERENCES teams(id),
+    away_team_id INTEGER REFERENCES teams(id),
+    event_url TEXT,
+    league_id INTEGER REFERENCES leagues(id),
+    line_up_url TEXT,
+    pim_total_team_1 INTEGER,
+    pim_total_team_2 INTEGER,
+    pp_perc_team_1 REAL,
+    pp_perc_team_2 REAL,
+    pp_time_team_1 TEXT,
+    pp_time_team_2 TEXT,
+    saves_total_team_1 INTEGER,
+    saves_total_team_2 INTEGER,
+    shots_total_team_1 INTEGER,
+    shots_total_team_2 INTEGER,
+    spectators INTEGER
+);
+INSERT INTO games_new SELECT
+    g.id, g.swehockey_id, g.date, g.arena, g.score_home, g.score_away,
+    s.home_id, s.away_id, g.event_url,
+    (SELECT id FROM leagues l WHERE l.name IS g.league),
+    g.line_up_url, g.pim_total_team_1, g.pim_total_team_2,
+    g.pp_perc_team_1, g.pp_perc_team_2, g.pp_time_team_1, g.pp_time_team_2,
+    g.saves_total_team_1, g.saves_total_team_2,
+    g.shots_total_team_1, g.shots_total_team_2, g.spectators
+FROM games g LEFT JOIN game_sides s ON s.swehockey_id = g.swehockey_id;
+DROP TABLE games;
+ALTER TABLE games_new RENAME TO games;
+
+CREATE TABLE lines_new(
+    swehockey_id INTEGER,
+    team_id INTEGER REFERENCES teams(id),
+    line_name TEXT,
+    player_id INTEGER REFERENCES players(id),
+    starting INTEGER,
+    UNIQUE (swehockey_id, team_id, line_name, player_id) ON CONFLICT IGNORE
+);
+INSERT INTO lines_new SELECT
+    l.swehockey_id, gt.team_id, l.line_name,
+    (SELECT id FROM players p WHERE p.first_name IS l.player_first_name
+        AND p.last_name IS l.player_last_name
+        AND p.number IS l.player_number AND p.team_id IS gt.team_id),
+    l.starting
+FROM lines l LEFT JOIN game_teams gt
+    ON gt.swehockey_id = l.swehockey_id AND gt.key = l.team
+ORDER BY l.rowid;
+DROP TABLE lines;
+ALTER TABLE lines_new RENAME TO lines;
+
+CREATE TABLE stats_by_period_new(
+    swehockey_id INTEGER,
+    team_id INTEGER REFERENCES teams(id),
+    stat_name TEXT,
+    period INTEGER,
+    stat INTEGER,
+    UNIQUE (swehockey_id, team_id, stat_name, period) ON CONFLICT IGNORE
+);
+INSERT INTO stats_by_period_new SELECT
+    s.swehockey_id, gt.team_id, s.stat_name, s.period, s.stat
+FROM stats_by_period s LEFT JOIN game_teams gt
+    ON gt.swehockey_id = s.swehockey_id AND gt.key = s.team_name
+ORDER BY s.rowid;
+DROP TABLE stats_by_period;
+ALTER TABLE stats_by_period_new RENAME TO stats_by_period;
+
+CREATE TABLE goalie_stats_new(
+    swehockey_id INTEGER,
+    team_id INTEGER REFERENCES teams(id),
+    player_id INTEGER REFERENCES players(id),
+    saves INTEGER,
+    shots INTEGER,
+    UNIQUE (swehockey_id, team_id, player_id) ON CONFLICT IGNORE
+);
+INSERT INTO goalie_stats_new SELECT
+    s.swehockey_id, gt.team_id,
+    (SELECT id FROM players p WHERE p.first_name IS s.first_name
+        AND p.last_name IS s.last_name
+        AND p.number IS s.player_number AND p.team_id IS gt.team_id),
+    s.saves, s.shots
+FROM goalie_stats s LEFT JOIN game_teams gt
+    ON gt.swehockey_id = s.swehockey_id AND gt.key = s.team_name
+ORDER BY s.rowid;
+DROP TABLE goalie_stats;
+ALTER TABLE goalie_stats_new RENAME TO goalie_stats;
+
+CREATE TABLE game_events_new(
+    id INTEGER PRIMARY KEY,
+    swehockey_id INTEGER,
+    seq INTEGER,
+    time TEXT,
+    team_id INTEGER REFERENCES teams(id),
+    event TEXT,
+    player_id INTEGER REFERENCES players(id),
+    assist_1_id INTEGER REFERENCES players(id),
+    assist_2_id INTEGER REFERENCES players(id),
+    type TEXT,
+    penalty_type TEXT,
+    penalty_start_time TEXT,
+    penalty_end_time TEXT,
+    ps_outcome TEXT,
+    ps_goalie_number INTEGER,
+    UNIQUE (swehockey_id, seq) ON CONFLICT IGNORE
+);
+INSERT INTO game_events_new SELECT
+    e.id, e.swehockey_id, e.seq, e.time, gt.team_id, e.event,
+    (SELECT id FROM players p WHERE e.player_last_name IS NOT NULL
+        AND p.first_name IS e.player_first_name
+        AND p.last_name IS e.player_last_name
+        AND p.number IS e.player_number AND p.team_id IS gt.team_id),
+    (SELECT id FROM players p WHERE e.assist_1_last_name IS NOT NULL
+        AND p.first_name IS e.assist_1_first_name
+        AND p.last_name IS e.assist_1_last_name
+        AND p.number IS e.assist_1_number AND p.team_id IS gt.team_id),
+    (SELECT id FROM players p WHERE e.assist_2_last_name IS NOT NULL
+        AND p.first_name IS e.assist_2_first_name
+        AND p.last_name IS e.assist_2_last_name
+        AND p.number IS e.assist_2_number AND p.team_id IS gt.team_id),
+    e.type, e.penalty_type, e.penalty_start_time, e.penalty_end_time,
+    e.ps_outcome, e.ps_goalie_number
+FROM game_events e LEFT JOIN game_teams gt
+    ON gt.swehockey_id = e.swehockey_id AND gt.key = e.team;
+DROP TABLE game_events;
+ALTER TABLE game_events_new RENAME TO game_events;
+
+CREATE TABLE shootouts_new(
+    swehockey_id INTEGER,
+    seq INTEGER,
+    scored TEXT,
+    score TEXT,
+    team_id INTEGER REFERENCES teams(id),
+    player_id INTEGER REFERENCES players(id),
+    goalie_id INTEGER REFERENCES players(id),
+    UNIQUE (swehockey_id, seq) ON CONFLICT IGNORE
+);
+INSERT INTO shootouts_new SELECT
+    s.swehockey_id, s.seq, s.scored, s.score, gt.team_id,
+    (SELECT id FROM players p WHERE p.first_name IS s.player_first_name
+        AND p.last_name IS s.player_last_name
+        AND p.number IS s.player_number AND p.team_id IS gt.team_id),
+    (SELECT id FROM players p WHERE p.first_name IS s.goalie_first_name
+        AND p.last_name IS s.goalie_last_name
+        AND p.number IS s.goalie_number AND p.team_id IS gt.opponent_id)
+FROM shootouts s LEFT JOIN game_teams gt
+    ON gt.swehockey_id = s.swehockey_id AND gt.key = s.team
+ORDER BY s.rowid;
+DROP TABLE shootouts;
+ALTER TABLE shootouts_new RENAME TO shootouts;
+
+DROP TABLE game_sides;
+DROP TABLE game_teams;
+
+CREATE INDEX games_date ON games(date, league_id);
+CREATE INDEX games_home_team_id ON games(home_team_id, date);
+CREATE INDEX games_away_team_id ON games(away_team_id, date);
+CREATE INDEX lines_player_id ON lines(player_id);
+CREATE INDEX lines_team_id ON lines(team_id, swehockey_id);
+CREATE INDEX stats_by_period_team_id ON stats_by_period(team_id, stat_name);
+CREATE INDEX goalie_stats_player_id ON goalie_stats(player_id);
+CREATE INDEX goalie_stats_team_id ON goalie_stats(team_id);
+CREATE INDEX game_events_player_id ON game_events(player_id);
+CREATE INDEX game_events_assist_1_id ON game_events(assist_1_id);
+CREATE INDEX game_events_assist_2_id ON game_events(assist_2_id);
+CREATE INDEX game_events_team_id ON game_events(team_id, type);
+CREATE INDEX shootouts_player_id ON shootouts(player_id);
+CREATE INDEX shootouts_goalie_id ON shootouts(goalie_id);
+"""
+
+# Version 4: hashes of the game pages of the stored games, by URL path,
+# so that unchanged pages are not parsed again (see PageHashMiddleware).
+PAGE_HASHES = """
+CREATE TABLE page_hashes(
+    url TEXT PRIMARY KEY,
+    hash TEXT NOT NULL
+);
+"""
+
+MIGRATIONS = [CREATE_TABLES, NARROW_KEYS, DIMENSIONS, PAGE_HASHES]
+
+
+def schema_version(con):
+    return con.execute("PRAGMA user_version").fetchone()[0]
+
+
+def migrate(con):
+    # Upgrade the database to the latest schema version.
+    version = schema_version(con)
+    if version > len(MIGRATIONS):
+        raise ValueError(
+            f"Database schema version {version} is newer than this code "
+            f"supports ({len(MIGRATIONS)})"
+        )
+    for version, script in enumerate(MIGRATIONS[version:], version + 1):
+        try:
+            con.executescript(
+                f"BEGIN;\n{script}\nPRAGMA user_version = {version};\nCOMMIT;"
+            )
+        except Exception:
+            if con.in_transaction:
+                con.rollback()
+            raise
+        logging.info(f"Upgraded database schema to version {version}")
@@ -0,0 +1,76 @@
+# Local stand-in for stats.swehockey.se, serving a recorded corpus
+# (see corpus.py) under the same URL layout as the real site:
+#
+#     /GamesByDate/<date>
+#     /Game/Events/<swehockey id>
+#     /Game/LineUps/<swehockey id>
+#     /ScheduleAndResults/Schedule/<schedule id>
+#
+# Used to load test the whole crawl and pipeline stack without
+# hammering the real site. Start it with $ scrapy mockserver <corpus>
+# and point the spider at it with -a base_url=http://127.0.0.1:8080
+
+import hashlib
+import random
+from urllib.parse import urlsplit
+
+from twisted.web import resource, server
+
+ROBOTS_TXT = b"User-agent: *\nDisallow:\n"
+
+
+class MockSwehockey(resource.Resource):
+    isLeaf = True
+
+    def __init__(self, corpus, latency=0.0, jitter=0.0, error_rate=0.0):
+        super().__init__()
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        # Corpus entries and their (gzip'd) files, by URL path.
+        self.corpus = corpus
+        self.pages = {
+            urlsplit(entry["url"]).path: entry for entry in corpus.entries()
+        }
+
+    def render_GET(self, request):
+        from twisted.internet import reactor
+
+        delay = max(
+            self.latency + random.uniform(-self.jitter, self.jitter), 0
+        )
+        reactor.callLater(delay, self.respond, request)
+        return server.NOT_DONE_YET
+
+    def respond(self, request):
+        if request._disconnected:
+            return
+        path = request.path.decode()
+        entry = self.pages.get(path)
+        if path == "/robots.txt":
+            request.setHeader(b"Content-Type", b"text/plain")
+            request.write(ROBOTS_TXT)
+        elif random.random() < self.error_rate:
+            request.setResponseCode(503)
+        elif entry is None:
+            request.setResponseCode(404)
+        else:
+            # Pages are read per request, so that a page can be replaced
+            # while a crawl runs, e.g. to test polling of live games.
+            body = self.corpus.read(entry)
+            etag = f'"{hashlib.md5(body).hexdigest()}"'.encode()
+            request.setHeader(b"ETag", etag)
+            if request.getHeader(b"If-None-Match") == etag:
+                request.setResponseCode(304)
+                request.finish()
+                return
+            request.setHeader(
+                b"Content-Type",
+                f"text/html; charset={entry['encoding']}".encode(),
+            )
+            request.write(body)
+        request.finish()
+
+
+def make_site(corpus, **kwargs):
+    return server.Site(MockSwehockey(corpus, **kwargs))
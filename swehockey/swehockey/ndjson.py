@@ -0,0 +1,134 @@
+# Streaming export of the scraped games to newline delimited JSON.
+#
+# Writes the same tables as ParquetPipeline (see parquet.py), one
+# file per table with one flat JSON object per row:
+#
+#     <NDJSON_EXPORT_DIR>/
+#         games.ndjson
+#         game_events.ndjson
+#         ...
+#
+# or games.ndjson.zst etc. with NDJSON_COMPRESSION = "zstd". Rows are
+# serialized as soon as they are built and written out in chunks of
+# NDJSON_FLUSH_BYTES, so memory use does not grow with the crawl.
+# Later crawls append to the files (a zstd file then holds one frame
+# per crawl, which zstd tools read as one stream).
+#
+# Uses orjson when it is installed, and zstandard for compression
+# (both in the ndjson extra). Enabled by setting NDJSON_EXPORT_DIR.
+
+import json
+import logging
+import os
+
+from scrapy.exceptions import NotConfigured
+
+from swehockey.parquet import CONVERTERS, TABLES
+from swehockey.items import LiveGameItem
+from swehockey.pipelines import RowPipeline
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Serialized rows buffered per table before they are written.
+FLUSH_BYTES = 2**20
+
+
+def dumps(row):
+    if orjson is not None:
+        return orjson.dumps(row, option=orjson.OPT_APPEND_NEWLINE)
+    return (
+        json.dumps(row, ensure_ascii=False, separators=(",", ":")) + "\n"
+    ).encode()
+
+
+class NdjsonPipeline(RowPipeline):
+    def __init__(self, path, compression=None, flush_bytes=FLUSH_BYTES):
+        self.path = path
+        self.compression = compression
+        self.flush_bytes = flush_bytes
+        # Serialized rows not yet written, and how many, and open files,
+        # by table.
+        self.buffers = {}
+        self.buffered_rows = {}
+        self.files = {}
+        self.row_counts = {}
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        path = crawler.settings.get("NDJSON_EXPORT_DIR")
+        if not path:
+            raise NotConfigured
+        compression = crawler.settings.get("NDJSON_COMPRESSION") or None
+        if compression not in (None, "zstd"):
+            raise NotConfigured(f"Unsupported NDJSON_COMPRESSION {compression!r}")
+        if compression == "zstd" and zstandard is None:
+            logging.error(
+                "NDJSON_COMPRESSION = 'zstd' requires zstandard, which is not "
+                "installed. Install it with: poetry install -E ndjson"
+            )
+            raise NotConfigured
+        pipeline = cls(
+            path,
+            compression=compression,
+            flush_bytes=crawler.settings.getint("NDJSON_FLUSH_BYTES", FLUSH_BYTES),
+        )
+        pipeline.profile(crawler)
+        return pipeline
+
+    def new_event_id(self, seq):
+        return seq
+
+    def buffer_row(self, table, d):
+        row = {
+            column: CONVERTERS[kind](d.get(column))
+            for column, kind in TABLES[table].items()
+        }
+        buffer = self.buffers.setdefault(table, bytearray())
+        buffer += dumps(row)
+        self.buffered_rows[table] = self.buffered_rows.get(table, 0) + 1
+        self.row_counts[table] = self.row_counts.get(table, 0) + 1
+        if len(buffer) >= self.flush_bytes:
+            self.flush(table)
+
+    def open(self, table):
+        os.makedirs(self.path, exist_ok=True)
+        name = f"{table}.ndjson"
+        if self.compression == "zstd":
+            name += ".zst"
+        f = open(os.path.join(self.path, name), "ab")
+        if self.compression == "zstd":
+            f = zstandard.ZstdCompressor().stream_writer(f)
+        return f
+
+    def flush(self, table):
+        buffer = self.buffers.pop(table, None)
+        if not buffer:
+            return
+        if table not in self.files:
+            self.files[table] = self.open(table)
+        self.files[table].write(buffer)
+        self.count_rows(table, self.buffered_rows.pop(table))
+
+    def process_item(self, item, spider):
+        # Games in progress (see LIVE_CRAWL) are exported once finished.
+        if isinstance(item, LiveGameItem):
+            return item
+        self.insert_item(item)
+        return item
+
+    def close_spider(self, spider):
+        for table in list(self.buffers):
+            self.flush(table)
+        for f in self.files.values():
+            f.close()
+        logging.info(
+            f"Wrote {sum(self.row_counts.values())} rows to {len(self.files)} NDJSON files in {self.path}"
+        )
@@ -0,0 +1,317 @@
+# Export of the scraped games to Parquet, alongside the sqlite database.
+#
+# Writes the same tables as SwehockeyPipeline, with names rather than
+# ids, as one dataset per table partitioned by season and league:
+#
+#     <PARQUET_EXPORT_DIR>/
+#         game_events/season=2013-2014/league=SHL/part-<run>-<n>.parquet
+#         ...
+#
+# The league of a game is only stored in the partition name. Every
+# crawl adds a new part to each partition it touches, and at most
+# PARQUET_MAX_OPEN_FILES parts are open at a time: a partition written
+# to again after its part was closed gets another part. Read a
+# table with pyarrow.dataset.dataset(path, partitioning="hive") or
+# pandas.read_parquet(path). Team, player and other repetitive text
+# columns are dictionary encoded. Game events are identified by their
+# position in the game (seq), which is also what plus_minus.event_id
+# refers to.
+#
+# Requires pyarrow (the parquet extra). Enabled by setting
+# PARQUET_EXPORT_DIR.
+
+import logging
+import os
+import uuid
+from collections import OrderedDict
+
+from scrapy.exceptions import NotConfigured
+
+from swehockey.items import LiveGameItem
+from swehockey.pipelines import RowPipeline
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+
+# Rows buffered per table and partition before they are written
+# as one record batch.
+BATCH_ROWS = 10000
+
+# Parquet files open at a time, across tables and partitions.
+MAX_OPEN_FILES = 128
+
+# Columns only stored in the partition names.
+PARTITION_COLUMNS = ("season", "league")
+
+# Column types of the tables: "int", "float", "text" or "dict"
+# (dictionary encoded text).
+TABLES = {
+    "games": {
+        "swehockey_id": "int",
+        "date": "text",
+        "arena": "dict",
+        "score_home": "int",
+        "score_away": "int",
+        "home_name": "dict",
+        "home_name_abbrev": "dict",
+        "away_name": "dict",
+        "away_name_abbrev": "dict",
+        "event_url": "text",
+        "league": "dict",
+        "line_up_url": "text",
+        "pim_total_team_1": "int",
+        "pim_total_team_2": "int",
+        "pp_perc_team_1": "float",
+        "pp_perc_team_2": "float",
+        "pp_time_team_1": "text",
+        "pp_time_team_2": "text",
+        "saves_total_team_1": "int",
+        "saves_total_team_2": "int",
+        "shots_total_team_1": "int",
+        "shots_total_team_2": "int",
+        "spectators": "int",
+    },
+    "lines": {
+        "swehockey_id": "int",
+        "team": "dict",
+        "line_name": "dict",
+        "player_first_name": "dict",
+        "player_last_name": "dict",
+        "player_number": "int",
+        "starting": "int",
+    },
+    "refs": {
+        "swehockey_id": "int",
+        "ref_name": "dict",
+        "position": "dict",
+    },
+    "stats_by_period": {
+        "swehockey_id": "int",
+        "team_name": "dict",
+        "stat_name": "dict",
+        "period": "int",
+        "stat": "int",
+    },
+    "goalie_stats": {
+        "swehockey_id": "int",
+        "team_name": "dict",
+        "first_name": "dict",
+        "last_name": "dict",
+        "player_number": "int",
+        "saves": "int",
+        "shots": "int",
+    },
+    "plus_minus": {
+        "event_id": "int",
+        "swehockey_id": "int",
+        "side": "dict",
+        "num": "int",
+    },
+    "game_events": {
+        "swehockey_id": "int",
+        "seq": "int",
+        "time": "text",
+        "team": "dict",
+        "event": "dict",
+        "player_first_name": "dict",
+        "player_last_name": "dict",
+        "player_number": "int",
+        "assist_1_first_name": "dict",
+        "assist_1_last_name": "dict",
+        "assist_1_number": "int",
+        "assist_2_first_name": "dict",
+        "assist_2_last_name": "dict",
+        "assist_2_number": "int",
+        "type": "dict",
+        "penalty_type": "dict",
+        "penalty_start_time": "text",
+        "penalty_end_time": "text",
+        "ps_outcome": "dict",
+        "ps_goalie_number": "int",
+    },
+    "shootouts": {
+        "swehockey_id": "int",
+        "seq": "int",
+        "scored": "dict",
+        "score": "text",
+        "team": "dict",
+        "player_first_name": "dict",
+        "player_last_name": "dict",
+        "player_number": "int",
+        "goalie_first_name": "dict",
+        "goalie_last_name": "dict",
+        "goalie_number": "int",
+    },
+}
+
+
+def to_int(value):
+    # Numbers as scraped, e.g. "12 044" spectators. Anything else,
+    # such as an empty string, is stored as null.
+    if isinstance(value, (bool, int)):
+        return int(value)
+    try:
+        return int(str(value).replace(" ", ""))
+    except ValueError:
+        return None
+
+
+def to_float(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def to_text(value):
+    if value is None or value == "":
+        return None
+    return str(value)
+
+
+CONVERTERS = {"int": to_int, "float": to_float, "text": to_text, "dict": to_text}
+
+
+def season(date):
+    # Season of a game from its date (YYYY-MM-DD ...). Seasons start
+    # in July, so 2014-01-01 is in the 2013-2014 season.
+    year, month = int(date[:4]), int(date[5:7])
+    start = year if month >= 7 else year - 1
+    return f"{start}-{start + 1}"
+
+
+def partition_name(value):
+    # Partition directory names must not contain path separators.
+    return str(value).replace("/", "_").replace(os.sep, "_")
+
+
+class ParquetPipeline(RowPipeline):
+    def __init__(self, path, batch_rows=BATCH_ROWS, max_open_files=MAX_OPEN_FILES):
+        self.path = path
+        self.batch_rows = batch_rows
+        self.max_open_files = max_open_files
+        self.run_id = uuid.uuid4().hex
+        self.columns = {
+            table: {
+                column: kind
+                for column, kind in columns.items()
+                if column not in PARTITION_COLUMNS
+            }
+            for table, columns in TABLES.items()
+        }
+        self.schemas = {
+            table: pa.schema(
+                [(column, self.arrow_type(kind)) for column, kind in columns.items()]
+            )
+            for table, columns in self.columns.items()
+        }
+        # Rows waiting to be written, open Parquet writers (least
+        # recently used first) and parts written, by (table, season,
+        # league).
+        self.rows = {}
+        self.writers = OrderedDict()
+        self.parts = {}
+        self.partition = None
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        path = crawler.settings.get("PARQUET_EXPORT_DIR")
+        if not path:
+            raise NotConfigured
+        if pa is None:
+            logging.error(
+                "PARQUET_EXPORT_DIR is set, but pyarrow is not installed. "
+                "Install it with: poetry install -E parquet"
+            )
+            raise NotConfigured
+        pipeline = cls(
+            path,
+            batch_rows=crawler.settings.getint("PARQUET_BATCH_ROWS", BATCH_ROWS),
+            max_open_files=crawler.settings.getint(
+                "PARQUET_MAX_OPEN_FILES", MAX_OPEN_FILES
+            ),
+        )
+        pipeline.profile(crawler)
+        return pipeline
+
+    @staticmethod
+    def arrow_type(kind):
+        if kind == "int":
+            return pa.int64()
+        if kind == "float":
+            return pa.float64()
+        if kind == "dict":
+            return pa.dictionary(pa.int32(), pa.string())
+        return pa.string()
+
+    def new_event_id(self, seq):
+        return seq
+
+    def buffer_row(self, table, d):
+        columns = self.columns[table]
+        key = (table,) + self.partition
+        rows = self.rows.setdefault(key, [])
+        rows.append(
+            {
+                column: CONVERTERS[kind](d.get(column))
+                for column, kind in columns.items()
+            }
+        )
+        if len(rows) >= self.batch_rows:
+            self.write_batch(key)
+
+    def write_batch(self, key):
+        rows = self.rows.pop(key, None)
+        if not rows:
+            return
+        writer = self.writers.get(key)
+        if writer is None:
+            writer = self.open_writer(key)
+        self.writers.move_to_end(key)
+        writer.write_batch(
+            pa.RecordBatch.from_pylist(rows, schema=self.schemas[key[0]])
+        )
+        self.count_rows(key[0], len(rows))
+
+    def open_writer(self, key):
+        # Start a new part of the partition, closing the least recently
+        # used part if too many are open. A backfill moves on from one
+        # season to the next, so old partitions are rarely reopened.
+        while len(self.writers) >= self.max_open_files:
+            self.writers.popitem(last=False)[1].close()
+        table, season, league = key
+        directory = os.path.join(
+            self.path,
+            table,
+            f"season={partition_name(season)}",
+            f"league={partition_name(league)}",
+        )
+        os.makedirs(directory, exist_ok=True)
+        part = self.parts[key] = self.parts.get(key, 0) + 1
+        writer = self.writers[key] = pq.ParquetWriter(
+            os.path.join(directory, f"part-{self.run_id}-{part}.parquet"),
+            self.schemas[table],
+            compression="zstd",
+        )
+        return writer
+
+    def process_item(self, item, spider):
+        # Games in progress (see LIVE_CRAWL) are exported once finished.
+        if isinstance(item, LiveGameItem):
+            return item
+        self.partition = (season(item["date_time"]), item["league"])
+        self.insert_item(item)
+        return item
+
+    def close_spider(self, spider):
+        for key in list(self.rows):
+            self.write_batch(key)
+        for writer in self.writers.values():
+            writer.close()
+        self.writers.clear()
+        logging.info(
+            f"Wrote {sum(self.parts.values())} Parquet files to {self.path}"
+        )
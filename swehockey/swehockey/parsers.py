@@ -0,0 +1,112 @@
+# Pure lxml versions of the hottest parts of the stats spider.
+#
+# These build exactly the same items as the EventItemLoader based
+# code in spiders/stats.py, but work on the lxml elements directly
+# instead of going through parsel selectors and the item loader
+# machinery. The game events parser is enabled with the
+# FAST_EVENT_PARSER setting, shootouts and lines are always parsed here.
+
+from swehockey.items import (
+    EventItem,
+    LineItem,
+    ShootoutItem,
+    clean,
+    parse_player,
+    parse_event_detail,
+    strip_goalie_prefix,
+)
+from swehockey.xpaths import XPATHS
+
+
+def direct_text(element):
+    # Equivalent of the "text()" XPath step: the text of the
+    # element itself followed by the tails of its children.
+    texts = [element.text] + [child.tail for child in element]
+    return [text for text in texts if text is not None]
+
+
+def first_text(texts):
+    # Equivalent of MapCompose(clean) followed by TakeFirst().
+    for text in texts:
+        text = clean(text)
+        if text:
+            return text
+    return ""
+
+
+def first_player(texts):
+    # Equivalent of MapCompose(clean, parse_player) followed by TakeFirst().
+    for text in texts:
+        player = parse_player(clean(text))
+        if player:
+            return player[0]
+    return ""
+
+
+def event_detail(texts, index):
+    # Equivalent of MapCompose(clean, parse_event_detail) followed by
+    # TakeFirst() on the index:th text node of the details column.
+    if len(texts) <= index:
+        return ""
+    return parse_event_detail(clean(texts[index])) or ""
+
+
+def parse_event_row(row):
+    # Build an EventItem from one <tr> of the game events table.
+    # The columns are the <td> children of the row (time, event,
+    # team, player and assists, details).
+    cells = [cell for cell in row if cell.tag == "td"]
+    cells += [None] * (5 - len(cells))
+    time, event, team, player, details = cells[:5]
+
+    item = EventItem()
+    item.time = first_text(direct_text(time)) if time is not None else ""
+    item.event = first_text(direct_text(event)) if event is not None else ""
+    item.team = first_text(direct_text(team)) if team is not None else ""
+
+    if player is not None:
+        assists = list(player.iter("div"))
+        item.player = first_player(direct_text(player))
+        item.assist_1 = (
+            first_player(direct_text(assists[0])) if len(assists) > 0 else ""
+        )
+        item.assist_2 = (
+            first_player(direct_text(assists[1])) if len(assists) > 1 else ""
+        )
+
+    texts = XPATHS["text_nodes"](details) if details is not None else []
+    item.details_1 = event_detail(texts, 0)
+    item.details_2 = event_detail(texts, 1)
+    return item
+
+
+def parse_event_rows(rows):
+    # Build an EventItem for each <tr> element of the game events table.
+    return [parse_event_row(row) for row in rows]
+
+
+def parse_shootout_row(row):
+    # Build a ShootoutItem from one <tr> of the shootout table.
+    return ShootoutItem(
+        scored=first_text(XPATHS["shootout_scored"](row)),
+        score=first_text(XPATHS["shootout_score"](row)),
+        team=first_text(XPATHS["shootout_team"](row)),
+        player=first_player(XPATHS["shootout_player"](row)),
+        goalie=first_player(
+            strip_goalie_prefix(clean(text))
+            for text in XPATHS["shootout_goalie"](row)
+        ),
+    )
+
+
+def parse_line(element):
+    # Build a LineItem from one line of a team's line up.
+    players = [
+        player
+        for text in XPATHS["line_players"](element)
+        for player in parse_player(clean(text))
+    ]
+    return LineItem(
+        line_name=first_text(XPATHS["line_name"](element)),
+        players=players or "",
+    )
@@ -6,171 +6,414 @@
 
 # useful for handling different item types with a single interface
 from itemadapter import ItemAdapter
+from scrapy.exceptions import DropItem
+from twisted.internet import defer
 import sqlite3
 import logging
+import queue
+import re
+import threading
+import time
+import os
+from abc import ABC, abstractmethod
+from collections import deque
+from urllib.parse import urlsplit
+
+from swehockey import signals
+from swehockey.corpus import page_hash
+from swehockey.items import LiveGameItem
+from swehockey.migrations import migrate
+from swehockey.profiling import timed
 
 DB_PATH = "db_name_here_1.db"
 
-
-class SwehockeyPipeline:
-    def __init__(self):
-        self.con = sqlite3.connect(DB_PATH)
-        self.cur = self.con.cursor()
-        self.create_games_table()
-        self.create_lines_table()
-        self.create_refs_table()
-        self.create_stats_by_period_table()
-        self.create_goalie_stats_table()
-        self.create_plus_minus_table()
-        self.create_game_events_table()
-        self.create_shootouts_table()
-
-    def create_shootouts_table(self):
-        self.cur.execute(
-            """CREATE TABLE IF NOT EXISTS shootouts(
-        swehockey_id INTEGER,
-        scored TEXT,
-        score TEXT,
-        team TEXT,
-        player_first_name TEXT,
-        player_last_name TEXT,
-        player_number INTEGER,
-        goalie_first_name TEXT,
-        goalie_last_name TEXT,
-        goalie_number INTEGER,
-        UNIQUE (swehockey_id, scored, score, team, player_number, goalie_number) ON CONFLICT IGNORE
-        )"""
-        )
-
-    def create_plus_minus_table(self):
-        self.cur.execute(
-            """CREATE TABLE IF NOT EXISTS plus_minus(
-        event_id INTEGER,
-        swehockey_id INTEGER,
-        side TEXT,
-        num INTEGER,
-        UNIQUE (event_id, swehockey_id, side, num) ON CONFLICT IGNORE
-        )"""
+# Buffered rows are written to the database in one transaction
+# every BATCH_GAMES games or every BATCH_SECONDS seconds,
+# whichever comes first.
+BATCH_GAMES = 50
+BATCH_SECONDS = 10
+
+# Maximum number of games waiting for the writer thread. When the
+# queue is full, items are held back until the writer catches up.
+QUEUE_SIZE = 100
+
+# Dimension tables and the columns of their natural keys
+# (see migrations.py).
+DIMENSIONS = {
+    "leagues": ("name",),
+    "teams": ("name", "abbrev"),
+    "players": ("first_name", "last_name", "number", "team_id"),
+}
+
+# Tables with rows of a single game, by swehockey_id. All of them are
+# deleted before a game is stored again (see delete_game()).
+GAME_TABLES = (
+    "games",
+    "lines",
+    "refs",
+    "stats_by_period",
+    "goalie_stats",
+    "plus_minus",
+    "game_events",
+    "shootouts",
+)
+
+# Player columns of the rows built by the insert_* methods, replaced
+# by a players id column: (first name, last name, number) -> id.
+PLAYER_COLUMNS = {
+    "lines": [
+        (("player_first_name", "player_last_name", "player_number"), "player_id")
+    ],
+    "goalie_stats": [(("first_name", "last_name", "player_number"), "player_id")],
+    "game_events": [
+        (("player_first_name", "player_last_name", "player_number"), "player_id"),
+        (("assist_1_first_name", "assist_1_last_name", "assist_1_number"), "assist_1_id"),
+        (("assist_2_first_name", "assist_2_last_name", "assist_2_number"), "assist_2_id"),
+    ],
+    "shootouts": [
+        (("player_first_name", "player_last_name", "player_number"), "player_id"),
+        (("goalie_first_name", "goalie_last_name", "goalie_number"), "goalie_id"),
+    ],
+}
+
+# Team column of the rows built by the insert_* methods, replaced by
+# a teams id column.
+TEAM_COLUMNS = {
+    "lines": "team",
+    "stats_by_period": "team_name",
+    "goalie_stats": "team_name",
+    "game_events": "team",
+    "shootouts": "team",
+}
+
+
+def load_game_ids(db_path=DB_PATH):
+    # Return the swehockey ids of all games stored in the database.
+    # Only finished games are stored, so these never need to be
+    # scraped again.
+    if not os.path.exists(db_path):
+        return set()
+    con = sqlite3.connect(db_path)
+    try:
+        rows = con.execute("SELECT swehockey_id FROM games")
+        return {str(row[0]) for row in rows}
+    except sqlite3.OperationalError:
+        # No games table yet.
+        return set()
+    finally:
+        con.close()
+
+
+def load_page_hashes(db_path=DB_PATH):
+    # Return the body hashes of the game pages of the stored games,
+    # by URL path (see PageHashMiddleware).
+    if not os.path.exists(db_path):
+        return {}
+    con = sqlite3.connect(db_path)
+    try:
+        return dict(con.execute("SELECT url, hash FROM page_hashes"))
+    except sqlite3.OperationalError:
+        # No page_hashes table yet.
+        return {}
+    finally:
+        con.close()
+
+
+def load_checkpoints(db_path=DB_PATH, kind="date"):
+    # Return the keys of the completed dates (kind="date") or
+    # games (kind="game") recorded in the checkpoints table.
+    if not os.path.exists(db_path):
+        return set()
+    con = sqlite3.connect(db_path)
+    try:
+        rows = con.execute(
+            "SELECT key FROM checkpoints WHERE kind = ?", (kind,)
         )
+        return {row[0] for row in rows}
+    except sqlite3.OperationalError:
+        # No checkpoints table yet.
+        return set()
+    finally:
+        con.close()
+
+
+# Queued by SqliteWriter.resume().
+RESUME = object()
+
+# Table of an INSERT statement built by generate_sql_dict().
+INSERT_TABLE = re.compile(r"INSERT OR \w+ INTO (\w+)")
+
+
+class SqliteWriter(threading.Thread):
+    # Writes buffered rows to the database on a dedicated thread,
+    # so that sqlite never blocks the Twisted reactor.
+    # All methods except run() are called from the reactor thread.
+
+    def __init__(
+        self,
+        con,
+        batch_games,
+        batch_seconds,
+        queue_size,
+        batch_failed=None,
+        rows_written=None,
+    ):
+        from twisted.internet import reactor
+
+        super().__init__(name="SqliteWriter", daemon=True)
+        self.reactor = reactor
+        self.con = con
+        self.batch_games = batch_games
+        self.batch_seconds = batch_seconds
+        self.queue = queue.Queue(maxsize=queue_size)
+        # Games that did not fit in the queue, in the order they arrived.
+        self.waiting = deque()
+        self.closing = False
+        self.stop_queued = False
+        self.closed = defer.Deferred()
+        # Called on the reactor thread with the swehockey ids of the games
+        # of a batch that could not be written. The games queued after a
+        # failed batch were built on its rows, so they are dropped until
+        # resume() is called, and then reported with dropped=True.
+        self.batch_failed = batch_failed
+        # Called on the reactor thread with the number of rows inserted
+        # per table by each batch that was written.
+        self.rows_written = rows_written
+
+        # Only touched by the writer thread. Rows are merged by statement
+        # within a segment of the batch, and the segments are written in
+        # order (see run()).
+        self.segments = [{}]
+        self.batch_ids = []
+        self.buffered_games = 0
+        self.last_flush = time.monotonic()
+        self.dropping = False
+        self.dropped_ids = []
+
+    def write(self, rows, swehockey_id=None):
+        # Hand the rows of one game (or of a date checkpoint, without a
+        # swehockey_id) to the writer thread. The returned Deferred
+        # fires once the writer has taken them off the queue.
+        d = defer.Deferred()
+        self.waiting.append((rows, swehockey_id, d))
+        self.fill_queue()
+        return d
+
+    def close(self):
+        # Flush what is left, including the games still waiting for room
+        # in the queue, and stop the thread. The returned Deferred fires
+        # when everything has been written.
+        self.closing = True
+        self.fill_queue()
+        return self.closed
+
+    def resume(self):
+        # Write the games queued from now on again, after a failed batch.
+        self.waiting.append(RESUME)
+        self.fill_queue()
+
+    def fill_queue(self):
+        # Never blocks: games that do not fit are queued as the writer
+        # takes games off the queue (see game_buffered()). The sentinel
+        # that stops the thread goes in after the last waiting game.
+        while self.waiting and not self.queue.full():
+            self.queue.put_nowait(self.waiting.popleft())
+        if (
+            self.closing
+            and not self.stop_queued
+            and not self.waiting
+            and not self.queue.full()
+        ):
+            self.queue.put_nowait(None)
+            self.stop_queued = True
+
+    def game_buffered(self, d):
+        self.fill_queue()
+        d.callback(None)
+
+    def run(self):
+        while True:
+            timeout = self.batch_seconds - (time.monotonic() - self.last_flush)
+            try:
+                job = self.queue.get(timeout=max(timeout, 0))
+            except queue.Empty:
+                self.flush()
+                continue
+            if job is None:
+                break
+            if job is RESUME:
+                self.dropping = False
+                self.report_dropped()
+                self.reactor.callFromThread(self.fill_queue)
+                continue
+
+            rows, swehockey_id, d = job
+            if self.dropping:
+                if swehockey_id is not None:
+                    self.dropped_ids.append(swehockey_id)
+                self.reactor.callFromThread(self.game_buffered, d)
+                continue
+            # The deletes of a game that is stored again must run after
+            # the rows of the games before it, and before its own rows,
+            # so they start a new segment.
+            if any(sql.startswith("DELETE") for sql in rows):
+                self.segments.append({})
+            segment = self.segments[-1]
+            for sql, values in rows.items():
+                segment.setdefault(sql, []).extend(values)
+            if swehockey_id is not None:
+                self.batch_ids.append(swehockey_id)
+            self.buffered_games += 1
+            # Under steady load the queue never times out, so check the
+            # age of the batch here as well.
+            if (
+                self.buffered_games >= self.batch_games
+                or time.monotonic() - self.last_flush >= self.batch_seconds
+            ):
+                self.flush()
+            self.reactor.callFromThread(self.game_buffered, d)
+
+        self.flush()
+        self.report_dropped()
+        self.con.close()
+        self.reactor.callFromThread(self.closed.callback, None)
+
+    def report_dropped(self):
+        if self.dropped_ids and self.batch_failed is not None:
+            self.reactor.callFromThread(
+                self.batch_failed, self.dropped_ids, dropped=True
+            )
+        self.dropped_ids = []
+
+    def flush(self):
+        # Write all buffered rows in a single transaction.
+        if any(self.segments):
+            counts = {}
+            try:
+                with self.con:
+                    for segment in self.segments:
+                        for sql, values in segment.items():
+                            cursor = self.con.executemany(sql, values)
+                            match = INSERT_TABLE.match(sql)
+                            if match:
+                                table = match.group(1)
+                                counts[table] = counts.get(table, 0) + cursor.rowcount
+            except sqlite3.Error:
+                logging.exception(
+                    f"Failed to write {self.buffered_games} games to the database."
+                )
+                if self.batch_failed is not None:
+                    self.dropping = True
+                    self.reactor.callFromThread(self.batch_failed, self.batch_ids)
+            else:
+                if self.rows_written is not None:
+                    self.reactor.callFromThread(self.rows_written, counts)
+        self.segments = [{}]
+        self.batch_ids = []
+        self.buffered_games = 0
+        self.last_flush = time.monotonic()
+
+
+class RowPipeline(ABC):
+    # Base of the pipelines that store an item as rows of the tables
+    # described in migrations.py. The insert_* methods build the rows,
+    # with names rather than ids, and hand them to buffer_row().
+
+    # Crawler stats, set by profile().
+    stats = None
+
+    @abstractmethod
+    def buffer_row(self, table, d):
+        # Store the row d (column: value) of table.
+        pass
 
-    def create_game_events_table(self):
-        self.cur.execute(
-            """CREATE TABLE IF NOT EXISTS game_events(
-        id INTEGER PRIMARY KEY,
-            swehockey_id INTEGER,
-            time TEXT,
-            team TEXT,
-            event TEXT,
-            player_first_name TEXT,
-            player_last_name TEXT,
-            player_number INTEGER,
-            assist_1_first_name TEXT,
-            assist_1_last_name TEXT,
-            assist_1_number INTEGER,
-            assist_2_first_name TEXT,
-            assist_2_last_name TEXT,
-            assist_2_number INTEGER,
-            type TEXT,
-            penalty_type TEXT,
-            penalty_start_time TEXT,
-            penalty_end_time TEXT,
-            ps_outcome TEXT,
-            ps_goalie_number INTEGER,
-            UNIQUE (swehockey_id, time, team, event, player_number, assist_1_number, assist_2_number, type, penalty_type, penalty_start_time, penalty_end_time, ps_outcome, ps_goalie_number) ON CONFLICT IGNORE
-        )"""
-        )
+    def profile(self, crawler):
+        # With PROFILE set, record the time of the insert_* methods
+        # and the number of rows written per table (see count_rows())
+        # in the crawler stats (see profiling.py). Called from
+        # from_crawler().
+        if not crawler.settings.getbool("PROFILE"):
+            return
+        self.stats = crawler.stats
+        pipeline = type(self).__name__
+        for name in dir(self):
+            if name.startswith("insert_"):
+                method = timed(getattr(self, name), self.stats, f"{pipeline}.{name}")
+                setattr(self, name, method)
+
+    def count_rows(self, table, rows):
+        # Called once rows of table were actually written, rather than
+        # when they are built, since a batch that fails is not stored.
+        if self.stats is not None:
+            self.stats.inc_value(f"rows/{type(self).__name__}/{table}", rows)
+
+    @abstractmethod
+    def new_event_id(self, seq):
+        # Id of the seq:th game event of the game, referred to by
+        # the plus_minus rows of the event.
+        pass
 
-    def create_goalie_stats_table(self):
-        self.cur.execute(
-            """CREATE TABLE IF NOT EXISTS goalie_stats(
-        swehockey_id INTEGER,
-        team_name TEXT,
-        first_name TEXT,
-        last_name TEXT,
-        player_number INTEGER,
-        saves INTEGER,
-        shots INTEGER,
-        UNIQUE (swehockey_id, team_name, player_number, saves, shots) ON CONFLICT IGNORE
-        )"""
+    def insert_item(self, item):
+        swehockey_id = item["swehockey_id"]
+        score_home = item["score"][0]
+        score_away = item["score"][1]
+        self.insert_lines(item, "lineup_home", swehockey_id)
+        self.insert_lines(item, "lineup_away", swehockey_id)
+        self.insert_coaches(item, "home_team_coaches", swehockey_id)
+        self.insert_coaches(item, "away_team_coaches", swehockey_id)
+        self.insert_refs(item, "refs", swehockey_id)
+        self.insert_refs(item, "linesmen", swehockey_id)
+        self.insert_stat_by_period(
+            item, "shots", "team_1", item["home_name"], swehockey_id
         )
-
-    def create_stats_by_period_table(self):
-        self.cur.execute(
-            """CREATE TABLE IF NOT EXISTS stats_by_period(
-        swehockey_id INTEGER,
-        team_name TEXT,
-        stat_name TEXT,
-        period INTEGER,
-        stat INTEGER,
-        UNIQUE (swehockey_id, team_name, stat_name, period, stat) ON CONFLICT IGNORE
-        )"""
+        self.insert_stat_by_period(
+            item, "shots", "team_2", item["away_name"], swehockey_id
         )
-
-    def create_refs_table(self):
-        self.cur.execute(
-            """CREATE TABLE IF NOT EXISTS refs(
-        swehockey_id INTEGER,
-        ref_name TEXT,
-        position TEXT,
-        UNIQUE (swehockey_id, ref_name, position) ON CONFLICT IGNORE
-        )"""
+        self.insert_stat_by_period(
+            item, "saves", "team_1", item["home_name"], swehockey_id
         )
-
-    def create_lines_table(self):
-        self.cur.execute(
-            """CREATE TABLE IF NOT EXISTS lines(
-            swehockey_id INTEGER,
-            team TEXT,
-            line_name TEXT,
-            player_first_name TEXT,
-            player_last_name TEXT,
-            player_number INTEGER,
-            starting INTEGER,
-            UNIQUE (swehockey_id, team, line_name, player_first_name, player_last_name, player_number, starting) ON CONFLICT IGNORE
-)"""
+        self.insert_stat_by_period(
+            item, "saves", "team_2", item["away_name"], swehockey_id
         )
-
-    def create_games_table(self):
-        self.cur.execute(
-            """CREATE TABLE IF NOT EXISTS games(
-            id INTEGER PRIMARY KEY,
-            swehockey_id INTEGER UNIQUE,
-            date TEXT,
-            arena TEXT,
-            score_home INTEGER, 
-            score_away INTEGER,
-            home_name TEXT,
-            home_name_abbrev TEXT,
-            away_name TEXT,
-            away_name_abbrev TEXT,
-            event_url TEXT,
-            league TEXT,
-            line_up_url TEXT,
-            pim_total_team_1 INTEGER,
-            pim_total_team_2 INTEGER,
-            pp_perc_team_1 REAL,
-            pp_perc_team_2 REAL,
-            pp_time_team_1 TEXT,
-            pp_time_team_2 TEXT,
-            saves_total_team_1 INTEGER,
-            saves_total_team_2 INTEGER,
-            shots_total_team_1 INTEGER,
-            shots_total_team_2 INTEGER,
-            spectators INTEGER
-        )"""
+        self.insert_stat_by_period(
+            item, "pim", "team_1", item["home_name"], swehockey_id
         )
-
-    def generate_sql_dict(self, table, d):
-        cols = ", ".join(d.keys())
-        var_str = ", ".join("?" * len(d))
-        return "INSERT OR IGNORE INTO %s (%s) VALUES (%s)" % (
-            table,
-            cols,
-            var_str,
+        self.insert_stat_by_period(
+            item, "pim", "team_2", item["away_name"], swehockey_id
         )
+        self.insert_score_by_period(item, swehockey_id)
+        self.insert_goalie_stats(item, swehockey_id)
+        self.insert_game_events(item, swehockey_id)
+        self.insert_shootout(item, swehockey_id)
 
-    def execute_db_query(self, sql):
-        pass
+        # TODO:
+        # swehockey id -> auto id
+        basic_stats = {
+            "swehockey_id": item["swehockey_id"],
+            "date": item["date_time"],
+            "arena": item["arena"],
+            "score_home": score_home,
+            "score_away": score_away,
+            "home_name": item["home_name"],
+            "home_name_abbrev": item["home_name_abbrev"],
+            "away_name": item["away_name"],
+            "away_name_abbrev": item["away_name_abbrev"],
+            "event_url": item["event_url"],
+            "league": item["league"],
+            "line_up_url": item["line_up_url"],
+            "pim_total_team_1": item["pim_total_team_1"],
+            "pim_total_team_2": item["pim_total_team_2"],
+            "pp_perc_team_1": item["pp_perc_team_1"],
+            "pp_perc_team_2": item["pp_perc_team_2"],
+            "pp_time_team_1": item["pp_time_team_1"],
+            "pp_time_team_2": item["pp_time_team_2"],
+            "saves_total_team_1": item["saves_total_team_1"],
+            "saves_total_team_2": item["saves_total_team_2"],
+            "shots_total_team_1": item["shots_total_team_1"],
+            "shots_total_team_2": item["shots_total_team_2"],
+            "spectators": item["spectators"],
+        }
+        self.buffer_row("games", basic_stats)
 
     def insert_coaches(self, item, team, swehockey_id):
         line = {
@@ -185,30 +428,28 @@ class SwehockeyPipeline:
             line["player_first_name"] = coaches[0][1]
             line["line_name"] = "Head Coach"
 
-            sql = self.generate_sql_dict("lines", line)
-            self.cur.execute(sql, list(line.values()))
+            self.buffer_row("lines", line)
         if len(coaches) > 1:
             line["player_number"] = 998
             line["player_last_name"] = coaches[1][0]
             line["player_first_name"] = coaches[1][1]
             line["line_name"] = "Assistant Coach"
 
-            sql = self.generate_sql_dict("lines", line)
-            self.cur.execute(sql, list(line.values()))
+            self.buffer_row("lines", line)
         if len(coaches) > 2:
             logging.warning(f"More than 2 coaches! ID: {swehockey_id}")
 
     def insert_lines(self, item, team, swehockey_id):
         line_name = ""
         for i in item["lineup"][team]:
-            if len(i["line_name"]) >= 1:
-                line_name = i["line_name"]
+            if len(i.line_name) >= 1:
+                line_name = i.line_name
             line = {
                 "line_name": line_name,
                 "team": team,
                 "swehockey_id": swehockey_id,
             }
-            for player in i["players"]:
+            for player in i.players:
                 line["player_number"] = player[0]
                 line["player_last_name"] = player[1]
                 line["player_first_name"] = player[2]
@@ -217,15 +458,13 @@ class SwehockeyPipeline:
                     for number in item["lineup"][f"starting_players_{team}"]
                 )
 
-                sql = self.generate_sql_dict("lines", line)
-                self.cur.execute(sql, list(line.values()))
+                self.buffer_row("lines", line)
 
     def insert_refs(self, item, position, swehockey_id):
         refs = {"swehockey_id": swehockey_id, "position": position}
         for ref in item["lineup"][position]:
             refs["ref_name"] = ref
-            sql = self.generate_sql_dict("refs", refs)
-            self.cur.execute(sql, list(refs.values()))
+            self.buffer_row("refs", refs)
 
     def insert_stat_by_period(self, item, stat, team, team_name, swehockey_id):
         stats = {
@@ -236,8 +475,7 @@ class SwehockeyPipeline:
         for stat in enumerate(item[f"{stat}_by_period_{team}"]):
             stats["period"] = str(stat[0] + 1)
             stats["stat"] = stat[1]
-            sql = self.generate_sql_dict("stats_by_period", stats)
-            self.cur.execute(sql, list(stats.values()))
+            self.buffer_row("stats_by_period", stats)
 
     def insert_score_by_period(self, item, swehockey_id):
         score = {"swehockey_id": swehockey_id, "stat_name": "score"}
@@ -247,13 +485,11 @@ class SwehockeyPipeline:
             score["period"] = str(period[0] + 1)
             score["stat"] = period[1][0]
             score["team_name"] = home_name
-            sql = self.generate_sql_dict("stats_by_period", score)
-            self.cur.execute(sql, list(score.values()))
+            self.buffer_row("stats_by_period", score)
 
             score["stat"] = period[1][1]
             score["team_name"] = away_name
-            sql = self.generate_sql_dict("stats_by_period", score)
-            self.cur.execute(sql, list(score.values()))
+            self.buffer_row("stats_by_period", score)
 
     def insert_goalie_stats(self, item, swehockey_id):
         stats = {"swehockey_id": swehockey_id}
@@ -269,33 +505,33 @@ class SwehockeyPipeline:
                 stats["shots"] = saves.split("/")[1]
                 stats["saves"] = saves.split("/")[0]
                 stats["team_name"] = team
-                sql = self.generate_sql_dict("goalie_stats", stats)
-                self.cur.execute(sql, list(stats.values()))
+                self.buffer_row("goalie_stats", stats)
 
     def insert_game_events(self, item, swehockey_id):
-        for event in item["game_events"]:
-            events = {"swehockey_id": swehockey_id}
-            player = event["player"]
-            assist_1 = event["assist_1"]
-            assist_2 = event["assist_2"]
-            events["time"] = event["time"]
-            events["team"] = event["team"]
-            events["event"] = event["event"]
+        for seq, event in enumerate(item["game_events"], 1):
+            event_id = self.new_event_id(seq)
+            events = {"id": event_id, "swehockey_id": swehockey_id, "seq": seq}
+            player = event.player
+            assist_1 = event.assist_1
+            assist_2 = event.assist_2
+            events["time"] = event.time
+            events["team"] = event.team
+            events["event"] = event.event
             if len(player) == 3:
-                events["player_first_name"] = event["player"][2]
-                events["player_last_name"] = event["player"][1]
-                events["player_number"] = event["player"][0]
+                events["player_first_name"] = event.player[2]
+                events["player_last_name"] = event.player[1]
+                events["player_number"] = event.player[0]
             if len(assist_1) == 3:
-                events["assist_1_first_name"] = event["assist_1"][2]
-                events["assist_1_last_name"] = event["assist_1"][1]
-                events["assist_1_number"] = event["assist_1"][0]
+                events["assist_1_first_name"] = event.assist_1[2]
+                events["assist_1_last_name"] = event.assist_1[1]
+                events["assist_1_number"] = event.assist_1[0]
             if len(assist_2) == 3:
-                events["assist_2_first_name"] = event["assist_2"][2]
-                events["assist_2_last_name"] = event["assist_2"][1]
-                events["assist_2_number"] = event["assist_2"][0]
+                events["assist_2_first_name"] = event.assist_2[2]
+                events["assist_2_last_name"] = event.assist_2[1]
+                events["assist_2_number"] = event.assist_2[0]
 
-            d1 = event["details_1"]
-            d2 = event["details_2"]
+            d1 = event.details_1
+            d2 = event.details_2
 
             # Penalty
             if len(d2) > 0:
@@ -311,7 +547,7 @@ class SwehockeyPipeline:
             if len(d1) > 0:
                 if d1["type"] == "goal":
                     events["type"] = "goal"
-                if d1["type"] == "goal" and "(PS)" in event["event"]:
+                if d1["type"] == "goal" and "(PS)" in event.event:
                     events["type"] = "penalty_shot"
                     events["ps_outcome"] = "scored"
                     if len(d2["on_ice_minus"]) != 1:
@@ -322,110 +558,408 @@ class SwehockeyPipeline:
                 if d1["type"] == "note" and d1["note"] == "PenaltyShot":
                     events["type"] = "Penalty Shot"
 
-            sql = self.generate_sql_dict("game_events", events)
-            self.cur.execute(sql, list(events.values()))
+            self.buffer_row("game_events", events)
 
             # Goal
             if len(d1) > 0:
                 if d1["type"] == "goal":
                     plus_minus = {
                         "swehockey_id": swehockey_id,
-                        "event_id": self.cur.lastrowid,
+                        "event_id": event_id,
                     }
 
                     for num in d1["on_ice_plus"]:
                         plus_minus["side"] = "plus"
                         plus_minus["num"] = num
-                        sql = self.generate_sql_dict("plus_minus", plus_minus)
-                        self.cur.execute(sql, list(plus_minus.values()))
+                        self.buffer_row("plus_minus", plus_minus)
 
                     for num in d2["on_ice_minus"]:
                         plus_minus["side"] = "minus"
                         plus_minus["num"] = num
-                        sql = self.generate_sql_dict("plus_minus", plus_minus)
-                        self.cur.execute(sql, list(plus_minus.values()))
+                        self.buffer_row("plus_minus", plus_minus)
 
     def insert_shootout(self, item, swehockey_id):
         if len(item["shootout_events"]) > 1:
-            for attempt in item["shootout_events"]:
-                shootout = {"swehockey_id": swehockey_id}
-                shootout["scored"] = attempt["scored"]
-                shootout["score"] = attempt["score"]
-                shootout["team"] = attempt["team"]
-                shootout["player_first_name"] = attempt["player"][2]
-                shootout["player_last_name"] = attempt["player"][1]
-                shootout["player_number"] = attempt["player"][0]
-                shootout["goalie_first_name"] = attempt["goalie"][2]
-                shootout["goalie_last_name"] = attempt["goalie"][1]
-                shootout["goalie_number"] = attempt["goalie"][0]
-
-                sql = self.generate_sql_dict("shootouts", shootout)
-                self.cur.execute(sql, list(shootout.values()))
-
-    def process_item(self, item, spider):
-        swehockey_id = item["swehockey_id"]
-        score_home = item["score"][0]
-        score_away = item["score"][1]
-        self.insert_lines(item, "lineup_home", swehockey_id)
-        self.insert_lines(item, "lineup_away", swehockey_id)
-        self.insert_coaches(item, "home_team_coaches", swehockey_id)
-        self.insert_coaches(item, "away_team_coaches", swehockey_id)
-        self.insert_refs(item, "refs", swehockey_id)
-        self.insert_refs(item, "linesmen", swehockey_id)
-        self.insert_stat_by_period(
-            item, "shots", "team_1", item["home_name"], swehockey_id
+            for seq, attempt in enumerate(item["shootout_events"], 1):
+                shootout = {"swehockey_id": swehockey_id, "seq": seq}
+                shootout["scored"] = attempt.scored
+                shootout["score"] = attempt.score
+                shootout["team"] = attempt.team
+                shootout["player_first_name"] = attempt.player[2]
+                shootout["player_last_name"] = attempt.player[1]
+                shootout["player_number"] = attempt.player[0]
+                shootout["goalie_first_name"] = attempt.goalie[2]
+                shootout["goalie_last_name"] = attempt.goalie[1]
+                shootout["goalie_number"] = attempt.goalie[0]
+
+                self.buffer_row("shootouts", shootout)
+
+
+class SwehockeyPipeline(RowPipeline):
+    def __init__(
+        self,
+        db_path=DB_PATH,
+        batch_games=BATCH_GAMES,
+        batch_seconds=BATCH_SECONDS,
+        queue_size=QUEUE_SIZE,
+    ):
+        # The connection is handed over to the writer thread once
+        # the schema is up to date (see migrations.py).
+        self.con = sqlite3.connect(db_path, check_same_thread=False)
+        self.cur = self.con.cursor()
+        migrate(self.con)
+
+        self.db_path = db_path
+        self.load_ids(self.con)
+
+        # Team ids of the game being processed, by the names, abbrevs
+        # and lineup sides used for its teams, and their opponents.
+        self.game_teams = {}
+        self.opponents = {}
+
+        # Rows of the game being processed, keyed by INSERT statement.
+        self.rows = {}
+
+        # Games not yet stored for each parsed date, and the reverse.
+        # A date is checkpointed once all of its games have been stored.
+        self.pending_dates = {}
+        self.game_dates = {}
+
+        # Ids of the games already in the database or stored by this
+        # crawl. Games are only stored once finished, so items for these
+        # are dropped before any rows are built for them, unless one of
+        # their pages changed since (see page_changed()).
+        self.cur.execute("SELECT swehockey_id FROM games")
+        self.stored_games = {str(row[0]) for row in self.cur}
+
+        self.event_ids = {}
+
+        # Body hashes of the pages of finished games by swehockey id and
+        # URL path, stored along with the game (see PageHashMiddleware).
+        self.page_hashes = {}
+        self.writer = SqliteWriter(
+            self.con,
+            batch_games,
+            batch_seconds,
+            queue_size,
+            self.batch_failed,
+            self.rows_written,
         )
-        self.insert_stat_by_period(
-            item, "shots", "team_2", item["away_name"], swehockey_id
+        # Set by from_crawler(), not when used on its own (see reparse).
+        self.crawler = None
+
+    def load_ids(self, con):
+        # Game event ids are assigned here rather than by sqlite,
+        # since plus_minus rows need them before the events are written.
+        cur = con.cursor()
+        cur.execute("SELECT MAX(id) FROM game_events")
+        self.next_event_id = (cur.fetchone()[0] or 0) + 1
+
+        # Ids of all leagues, teams and players by natural key. These
+        # are loaded once (and again after a batch failed, see
+        # batch_failed()) and new rows get their ids here too, so that
+        # names are turned into ids without a SELECT per row.
+        self.ids = {}
+        self.next_ids = {}
+        for table, columns in DIMENSIONS.items():
+            cur.execute(f"SELECT id, {', '.join(columns)} FROM {table}")
+            self.ids[table] = {tuple(row[1:]): row[0] for row in cur}
+            self.next_ids[table] = max(self.ids[table].values(), default=0) + 1
+
+        # Game event ids of the games in progress stored by LIVE_CRAWL
+        # updates, by seq. Events stored again, by a later update or
+        # the final item of the game, keep their ids. Each of them
+        # deletes the stored rows of the game and stores it as a whole,
+        # so that events corrected or removed during the game are gone.
+        self.live_event_ids = {}
+        cur.execute(
+            """SELECT DISTINCT swehockey_id FROM stats_by_period
+            WHERE swehockey_id NOT IN (SELECT swehockey_id FROM games)"""
         )
-        self.insert_stat_by_period(
-            item, "saves", "team_1", item["home_name"], swehockey_id
+        for (swehockey_id,) in cur:
+            self.live_event_ids[str(swehockey_id)] = {}
+        cur.execute(
+            """SELECT swehockey_id, seq, id FROM game_events
+            WHERE swehockey_id NOT IN (SELECT swehockey_id FROM games)"""
         )
-        self.insert_stat_by_period(
-            item, "saves", "team_2", item["away_name"], swehockey_id
+        for swehockey_id, seq, event_id in cur:
+            self.live_event_ids.setdefault(str(swehockey_id), {})[seq] = event_id
+
+        # Hashes of the stored game pages by URL path.
+        cur.execute("SELECT url, hash FROM page_hashes")
+        self.stored_hashes = dict(cur)
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        pipeline = cls(
+            db_path=crawler.settings.get("SQLITE_DB_PATH", DB_PATH),
+            batch_games=crawler.settings.getint(
+                "SQLITE_BATCH_GAMES", BATCH_GAMES
+            ),
+            batch_seconds=crawler.settings.getfloat(
+                "SQLITE_BATCH_SECONDS", BATCH_SECONDS
+            ),
+            queue_size=crawler.settings.getint(
+                "SQLITE_QUEUE_SIZE", QUEUE_SIZE
+            ),
         )
-        self.insert_stat_by_period(
-            item, "pim", "team_1", item["home_name"], swehockey_id
+        crawler.signals.connect(
+            pipeline.date_parsed, signal=signals.date_parsed
         )
-        self.insert_stat_by_period(
-            item, "pim", "team_2", item["away_name"], swehockey_id
+        crawler.signals.connect(
+            pipeline.game_finished, signal=signals.game_finished
+        )
+        pipeline.profile(crawler)
+        pipeline.crawler = crawler
+        return pipeline
+
+    def open_spider(self, spider):
+        self.writer.start()
+
+    def close_spider(self, spider):
+        return self.writer.close()
+
+    def batch_failed(self, game_ids, dropped=False):
+        # The games of a batch that could not be written were not stored
+        # after all, so they are crawled again by a later run. The crawl
+        # is stopped, since the next batches would most likely fail too.
+        #
+        # Nor were the leagues, teams, players and game events that got
+        # their ids in the batch, so the ids are loaded from the database
+        # again. The games already handed to the writer refer to the lost
+        # ids, so the writer drops them until resume(), and reports them
+        # with dropped set.
+        logging.error(f"{len(game_ids)} games were not stored.")
+        self.stored_games.difference_update(game_ids)
+        if not dropped:
+            con = sqlite3.connect(self.db_path)
+            try:
+                self.load_ids(con)
+            finally:
+                con.close()
+            self.writer.resume()
+        if self.crawler is None:
+            return
+        self.crawler.stats.inc_value("sqlite/failed_games", len(game_ids))
+        if self.crawler.crawling:
+            self.crawler.engine.close_spider(self.crawler.spider, "sqlite_error")
+
+    def rows_written(self, counts):
+        for table, rows in counts.items():
+            self.count_rows(table, rows)
+
+    def date_parsed(self, date, game_ids):
+        # Games listed on several dates may already have been stored.
+        game_ids = set(game_ids) - self.stored_games
+        if not game_ids:
+            self.buffer_row("checkpoints", {"kind": "date", "key": date})
+            rows, self.rows = self.rows, {}
+            self.writer.write(rows)
+            return
+        self.pending_dates[date] = game_ids
+        for swehockey_id in game_ids:
+            self.game_dates.setdefault(swehockey_id, set()).add(date)
+
+    def game_finished(self, response, swehockey_id):
+        path = urlsplit(response.url).path
+        hashes = self.page_hashes.setdefault(swehockey_id, {})
+        hashes[path] = page_hash(response.body)
+
+    def insert_page_hashes(self, swehockey_id):
+        for url, hash in self.page_hashes.pop(swehockey_id, {}).items():
+            self.buffer_row("page_hashes", {"url": url, "hash": hash})
+            self.stored_hashes[url] = hash
+
+    def page_changed(self, swehockey_id):
+        # Whether a page of a stored game differs from when the game was
+        # stored. Games stored before their pages were hashed count as
+        # unchanged.
+        return any(
+            self.stored_hashes.get(url, hash) != hash
+            for url, hash in self.page_hashes.get(swehockey_id, {}).items()
+        )
+
+    def insert_checkpoints(self, swehockey_id):
+        # Record the game as completed, along with any date that
+        # has no other games left to store. These rows are written in
+        # the same transaction as the game itself.
+        self.buffer_row("checkpoints", {"kind": "game", "key": swehockey_id})
+        self.stored_games.add(swehockey_id)
+        for date in self.game_dates.pop(swehockey_id, ()):
+            pending = self.pending_dates[date]
+            pending.discard(swehockey_id)
+            if not pending:
+                del self.pending_dates[date]
+                self.buffer_row("checkpoints", {"kind": "date", "key": date})
+
+    def generate_sql_dict(self, table, d):
+        cols = ", ".join(d.keys())
+        var_str = ", ".join("?" * len(d))
+        # Page hashes are replaced when a page changed (see
+        # PageHashMiddleware).
+        if table == "page_hashes":
+            conflict = "REPLACE"
+        else:
+            conflict = "IGNORE"
+        return "INSERT OR %s INTO %s (%s) VALUES (%s)" % (
+            conflict,
+            table,
+            cols,
+            var_str,
+        )
+
+    def execute_db_query(self, sql):
+        pass
+
+    def buffer_row(self, table, d):
+        # Queue a row for insertion. Rows with the same table and
+        # columns share an INSERT statement, so they can be written
+        # with a single executemany.
+        d = self.normalize(table, d)
+        sql = self.generate_sql_dict(table, d)
+        self.rows.setdefault(sql, []).append(list(d.values()))
+
+    def new_event_id(self, seq):
+        if seq in self.event_ids:
+            return self.event_ids[seq]
+        event_id = self.event_ids[seq] = self.next_event_id
+        self.next_event_id += 1
+        return event_id
+
+    def dimension_id(self, table, *key):
+        # Return the id of a league, team or player, buffering a new
+        # row for keys not seen before.
+        ids = self.ids[table]
+        if key not in ids:
+            ids[key] = self.next_ids[table]
+            self.next_ids[table] += 1
+            row = dict(zip(DIMENSIONS[table], key), id=ids[key])
+            self.buffer_row(table, row)
+        return ids[key]
+
+    def player_id(self, first_name, last_name, number, team_id):
+        # Numbers are read back from sqlite as integers.
+        if isinstance(number, str) and number.isdigit():
+            number = int(number)
+        return self.dimension_id(
+            "players", first_name, last_name, number, team_id
         )
+
+    def set_game_teams(self, item):
+        home_id = self.dimension_id(
+            "teams", item["home_name"], item["home_name_abbrev"]
+        )
+        away_id = self.dimension_id(
+            "teams", item["away_name"], item["away_name_abbrev"]
+        )
+        self.game_teams = {
+            item["home_name"]: home_id,
+            item["home_name_abbrev"]: home_id,
+            "lineup_home": home_id,
+            "home_team_coaches": home_id,
+            item["away_name"]: away_id,
+            item["away_name_abbrev"]: away_id,
+            "lineup_away": away_id,
+            "away_team_coaches": away_id,
+        }
+        self.opponents = {home_id: away_id, away_id: home_id}
+
+    def normalize(self, table, d):
+        # Replace the league, team and player names of a row built by
+        # the insert_* methods by ids. Returns a new dict, since the
+        # insert_* methods reuse theirs between rows.
+        d = dict(d)
+        if table == "games":
+            d["home_team_id"] = self.dimension_id(
+                "teams", d.pop("home_name"), d.pop("home_name_abbrev")
+            )
+            d["away_team_id"] = self.dimension_id(
+                "teams", d.pop("away_name"), d.pop("away_name_abbrev")
+            )
+            d["league_id"] = self.dimension_id("leagues", d.pop("league"))
+            return d
+        if table not in TEAM_COLUMNS:
+            return d
+
+        team = d.pop(TEAM_COLUMNS[table])
+        team_id = self.game_teams.get(team)
+        if team and team_id is None:
+            logging.warning(
+                f"Unknown team '{team}' in {table}. ID: {d['swehockey_id']}"
+            )
+        d["team_id"] = team_id
+        for columns, id_column in PLAYER_COLUMNS.get(table, ()):
+            if columns[1] not in d:
+                continue
+            # Shootout goalies play for the other team.
+            player_team_id = (
+                self.opponents.get(team_id) if id_column == "goalie_id" else team_id
+            )
+            d[id_column] = self.player_id(
+                *(d.pop(column) for column in columns), player_team_id
+            )
+        return d
+
+    def process_item(self, item, spider):
+        swehockey_id = item["swehockey_id"]
+        stored = swehockey_id in self.stored_games
+        if stored and not self.page_changed(swehockey_id):
+            # Games stored before their pages were hashed get their
+            # hashes here, so that later crawls skip their pages.
+            self.insert_page_hashes(swehockey_id)
+            if self.rows:
+                rows, self.rows = self.rows, {}
+                self.writer.write(rows)
+            raise DropItem(f"Game {swehockey_id} is already stored")
+        if isinstance(item, LiveGameItem):
+            return self.process_live_item(item)
+        self.event_ids = self.live_event_ids.pop(swehockey_id, None)
+        if stored:
+            # Corrected on the site since it was stored.
+            logging.info(f"Game {swehockey_id} changed, storing it again.")
+            self.delete_game(swehockey_id)
+        elif self.event_ids is not None:
+            # The rows of the live updates are replaced as a whole, so
+            # that events corrected or removed during the game are gone.
+            self.delete_game(swehockey_id)
+        if self.event_ids is None:
+            self.event_ids = {}
+        self.set_game_teams(item)
+        self.insert_item(item)
+        self.insert_checkpoints(swehockey_id)
+        self.insert_page_hashes(swehockey_id)
+
+        rows, self.rows = self.rows, {}
+        d = self.writer.write(rows, swehockey_id)
+        d.addCallback(lambda _: item)
+        return d
+
+    def delete_game(self, swehockey_id):
+        # Delete the stored rows of a game before it is stored again.
+        # Its events keep their ids if they are in self.event_ids.
+        for table in GAME_TABLES:
+            sql = f"DELETE FROM {table} WHERE swehockey_id = ?"
+            self.rows[sql] = [[swehockey_id]]
+
+    def process_live_item(self, item):
+        # Replace the game events and totals by period of a game in
+        # progress by those of the update. The game itself is stored by
+        # its final item.
+        swehockey_id = item["swehockey_id"]
+        self.event_ids = self.live_event_ids.setdefault(swehockey_id, {})
+        self.delete_game(swehockey_id)
+        self.set_game_teams(item)
+        for stat in ("shots", "saves", "pim"):
+            self.insert_stat_by_period(
+                item, stat, "team_1", item["home_name"], swehockey_id
+            )
+            self.insert_stat_by_period(
+                item, stat, "team_2", item["away_name"], swehockey_id
+            )
         self.insert_score_by_period(item, swehockey_id)
-        self.insert_goalie_stats(item, swehockey_id)
         self.insert_game_events(item, swehockey_id)
-        self.insert_shootout(item, swehockey_id)
 
-        # TODO:
-        # Players -> player table with ID
-        # Teams -> teams table with ID
-        # Leagues -> league table with ID
-        # swehockey id -> auto id
-        basic_stats = {
-            "swehockey_id": item["swehockey_id"],
-            "date": item["date_time"],
-            "arena": item["arena"],
-            "score_home": score_home,
-            "score_away": score_away,
-            "home_name": item["home_name"],
-            "home_name_abbrev": item["home_name_abbrev"],
-            "away_name": item["away_name"],
-            "away_name_abbrev": item["away_name_abbrev"],
-            "event_url": item["event_url"],
-            "league": item["league"],
-            "line_up_url": item["line_up_url"],
-            "pim_total_team_1": item["pim_total_team_1"],
-            "pim_total_team_2": item["pim_total_team_2"],
-            "pp_perc_team_1": item["pp_perc_team_1"],
-            "pp_perc_team_2": item["pp_perc_team_2"],
-            "pp_time_team_1": item["pp_time_team_1"],
-            "pp_time_team_2": item["pp_time_team_2"],
-            "saves_total_team_1": item["saves_total_team_1"],
-            "saves_total_team_2": item["saves_total_team_2"],
-            "shots_total_team_1": item["shots_total_team_1"],
-            "shots_total_team_2": item["shots_total_team_2"],
-            "spectators": item["spectators"],
-        }
-        sql = self.generate_sql_dict("games", basic_stats)
-        self.cur.execute(sql, list(basic_stats.values()))
-        self.con.commit()
-        return item
+        rows, self.rows = self.rows, {}
+        d = self.writer.write(rows)
+        d.addCallback(lambda _: item)
+        return d
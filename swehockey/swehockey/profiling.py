@@ -0,0 +1,101 @@
+# Wall and CPU time of spider callbacks and pipeline methods, recorded
+# in the crawler stats as
+#
+#     profile/<name>/wall_seconds
+#     profile/<name>/cpu_seconds
+#     profile/<name>/calls
+#
+# CPU time is that of the calling thread, which for callbacks and
+# pipelines is the reactor thread. Enabled by setting PROFILE, see
+# ProfilingMiddleware and RowPipeline.profile().
+
+import re
+import time
+from functools import wraps
+
+
+class Timer:
+    # Accumulates the time spent between start() and stop() calls.
+
+    def __init__(self):
+        self.wall = 0.0
+        self.cpu = 0.0
+
+    def start(self):
+        self.wall_start = time.perf_counter()
+        self.cpu_start = time.thread_time()
+
+    def stop(self):
+        self.wall += time.perf_counter() - self.wall_start
+        self.cpu += time.thread_time() - self.cpu_start
+
+    def record(self, stats, name):
+        stats.inc_value(f"profile/{name}/wall_seconds", self.wall)
+        stats.inc_value(f"profile/{name}/cpu_seconds", self.cpu)
+        stats.inc_value(f"profile/{name}/calls")
+
+
+def timed(func, stats, name):
+    # Wrap func so that the time of every call is recorded in stats.
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        timer = Timer()
+        timer.start()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            timer.stop()
+            timer.record(stats, name)
+
+    return wrapper
+
+
+def profile_stats(stats):
+    # Return {name: {"wall_seconds": ..., "cpu_seconds": ..., "calls": ...}}
+    # of everything recorded so far.
+    result = {}
+    for key, value in stats.get_stats().items():
+        match = re.fullmatch(r"profile/(.+)/(\w+)", key)
+        if match:
+            result.setdefault(match.group(1), {})[match.group(2)] = value
+    return result
+
+
+def row_stats(stats):
+    # Return {(pipeline, table): rows} recorded by RowPipeline.count_rows().
+    result = {}
+    for key, value in stats.get_stats().items():
+        match = re.fullmatch(r"rows/(\w+)/(\w+)", key)
+        if match:
+            result[match.groups()] = value
+    return result
+
+
+def prometheus_text(stats):
+    # The profile, rows and item counts in the Prometheus text format,
+    # for the node_exporter textfile collector.
+    lines = []
+    profile = profile_stats(stats)
+    for metric, help_text in [
+        ("wall_seconds", "Wall time spent"),
+        ("cpu_seconds", "CPU time spent"),
+        ("calls", "Number of calls"),
+    ]:
+        lines.append(f"# HELP swehockey_{metric}_total {help_text}.")
+        lines.append(f"# TYPE swehockey_{metric}_total counter")
+        for name, values in sorted(profile.items()):
+            lines.append(
+                f'swehockey_{metric}_total{{name="{name}"}} {values.get(metric, 0)}'
+            )
+    lines.append("# HELP swehockey_rows_total Rows written per table.")
+    lines.append("# TYPE swehockey_rows_total counter")
+    for (pipeline, table), rows in sorted(row_stats(stats).items()):
+        lines.append(
+            f'swehockey_rows_total{{pipeline="{pipeline}",table="{table}"}} {rows}'
+        )
+    lines.append("# HELP swehockey_items_scraped_total Items scraped.")
+    lines.append("# TYPE swehockey_items_scraped_total counter")
+    lines.append(
+        f"swehockey_items_scraped_total {stats.get_value('item_scraped_count', 0)}"
+    )
+    return "\n".join(lines) + "\n"
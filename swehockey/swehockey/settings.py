@@ -11,6 +11,7 @@ BOT_NAME = "swehockey"
 
 SPIDER_MODULES = ["swehockey.spiders"]
 NEWSPIDER_MODULE = "swehockey.spiders"
+COMMANDS_MODULE = "swehockey.commands"
 
 
 # Crawl responsibly by identifying yourself (and your website) on the user-agent
@@ -44,15 +45,47 @@ ROBOTSTXT_OBEY = True
 
 # Enable or disable spider middlewares
 # See https://docs.scrapy.org/en/latest/topics/spider-middleware.html
-# SPIDER_MIDDLEWARES = {
-#    'swehockey.middlewares.SwehockeySpiderMiddleware': 543,
-# }
+SPIDER_MIDDLEWARES = {
+    # Only active when PROFILE is set. Placed right next to the spider,
+    # so that only the callbacks themselves are timed.
+    "swehockey.middlewares.ProfilingMiddleware": 950,
+}
+
+# Record the time spent in each spider callback and pipeline insert
+# method, and the rows written per table, in the crawler stats. Logged
+# every PROFILE_INTERVAL seconds (default: 60) and optionally written
+# to a Prometheus textfile.
+# PROFILE = False
+# PROFILE_INTERVAL = 60
+# PROFILE_PROMETHEUS_FILE = "swehockey.prom"
 
 # Enable or disable downloader middlewares
 # See https://docs.scrapy.org/en/latest/topics/downloader-middleware.html
-# DOWNLOADER_MIDDLEWARES = {
-#    'swehockey.middlewares.SwehockeyDownloaderMiddleware': 543,
-# }
+DOWNLOADER_MIDDLEWARES = {
+    # Only active when GAME_CACHE_PATH is set.
+    "swehockey.middlewares.SwehockeyDownloaderMiddleware": 543,
+    # Only active when PAGE_HASH_SKIP is set.
+    "swehockey.middlewares.PageHashMiddleware": 555,
+    # Only active when POLITENESS_ENABLED is set.
+    "swehockey.middlewares.PolitenessMiddleware": 565,
+    # Only active when CORPUS_RECORD_DIR is set.
+    "swehockey.middlewares.CorpusRecorderMiddleware": 585,
+}
+
+# Skip games whose pages are the same as when they were stored, without
+# parsing them, using the page_hashes table of the database.
+# See PageHashMiddleware.
+# PAGE_HASH_SKIP = False
+
+# Record all downloaded pages to an offline corpus directory, to be
+# used with $ scrapy benchparse <dir>
+# CORPUS_RECORD_DIR = "corpus"
+
+# Keep the pages of finished games forever in a compressed sqlite file
+# and serve them from there on later crawls. Date pages and unfinished
+# games are always downloaded. See cache.py.
+# GAME_CACHE_PATH = "game_cache.db"
+# GAME_CACHE_STORAGE = "swehockey.cache.SqliteBlobStorage"
 
 # Enable or disable extensions
 # See https://docs.scrapy.org/en/latest/topics/extensions.html
@@ -64,8 +97,93 @@ ROBOTSTXT_OBEY = True
 # See https://docs.scrapy.org/en/latest/topics/item-pipeline.html
 ITEM_PIPELINES = {
     "swehockey.pipelines.SwehockeyPipeline": 300,
+    # Only active when PARQUET_EXPORT_DIR is set.
+    "swehockey.parquet.ParquetPipeline": 310,
+    # Only active when NDJSON_EXPORT_DIR is set.
+    "swehockey.ndjson.NdjsonPipeline": 320,
 }
 
+# Also write the tables to Parquet files, partitioned by season and
+# league, in this directory. Requires pyarrow (the parquet extra). See parquet.py.
+# PARQUET_EXPORT_DIR = "parquet"
+# Rows buffered per table and partition before they are written
+# (default: 10000).
+# PARQUET_BATCH_ROWS = 10000
+# Parquet files kept open at a time; the least recently written one
+# is closed beyond that (default: 128).
+# PARQUET_MAX_OPEN_FILES = 128
+
+# Also write the tables as newline delimited JSON, one file per table,
+# to this directory. See ndjson.py.
+# NDJSON_EXPORT_DIR = "ndjson"
+# Compress the files with zstd (requires zstandard, from the ndjson extra).
+# NDJSON_COMPRESSION = "zstd"
+# Bytes buffered per table before they are written (default: 1 MiB).
+# NDJSON_FLUSH_BYTES = 1048576
+
+# Parse the game events table with the pure lxml parser in parsers.py
+# instead of item loaders. Check it against saved pages with
+# $ scrapy checkevents <pages>
+# (the pages in tests/pages are checked by the test suite).
+# FAST_EVENT_PARSER = False
+
+# Path of the sqlite database the pipeline writes to.
+# SQLITE_DB_PATH = "db_name_here_1.db"
+
+# Only scrape games that are not already in the database.
+# INCREMENTAL_CRAWL = False
+
+# Resume an interrupted crawl, skipping the dates and games that were
+# completed according to the checkpoints table.
+# RESUME_CRAWL = False
+
+# The events and line up pages of a game are requested together, and
+# the game is stored once both have come back. Games whose line up page
+# failed are dropped, so that a later crawl fetches them again, unless
+# GAME_JOIN_PARTIAL_ITEMS is set.
+# GAME_JOIN_PARTIAL_ITEMS = False
+
+# Games waiting for their pages are kept in memory, and beyond
+# GAME_STATE_MEMORY_GAMES spilled to a sqlite file (see state.py), by
+# default game_state.db in the JOBDIR when there is one.
+# GAME_STATE_PATH = "game_state.db"
+# GAME_STATE_MEMORY_GAMES = 10000
+
+# Keep polling games that are still in progress until they finish,
+# storing their new game events and per-period totals as they come in.
+# A game is polled again after LIVE_POLL_MIN_INTERVAL seconds when it
+# changed, otherwise after twice the last interval, up to
+# LIVE_POLL_MAX_INTERVAL, and given up after LIVE_POLL_HOURS.
+# LIVE_CRAWL = False
+# LIVE_POLL_MIN_INTERVAL = 30
+# LIVE_POLL_MAX_INTERVAL = 300
+# LIVE_POLL_HOURS = 6
+
+# Write buffered rows to the sqlite database every N games or T seconds,
+# whichever comes first (defaults: 50 games, 10 seconds).
+# SQLITE_BATCH_GAMES = 50
+# SQLITE_BATCH_SECONDS = 10
+# Maximum number of games waiting for the sqlite writer thread before
+# new items are held back (default: 100).
+# SQLITE_QUEUE_SIZE = 100
+
+# Adjust concurrency and delay to the response times and error rate of
+# the site, with separate budgets for date pages and game pages. See
+# PolitenessMiddleware. The total is still capped by CONCURRENT_REQUESTS.
+# POLITENESS_ENABLED = False
+# POLITENESS_DATE_CONCURRENCY = 4
+# POLITENESS_GAME_CONCURRENCY = 16
+# Never wait longer than this between requests (seconds).
+# POLITENESS_MAX_DELAY = 30
+# Adjust after every N responses, backing off when the median latency
+# exceeds SLOWDOWN times the baseline (the 10th percentile of the recent
+# latencies, at least MIN_BASELINE seconds), or more than MAX_ERROR_RATE
+# of the responses are 5xx/429 or failed.
+# POLITENESS_WINDOW = 10
+# POLITENESS_SLOWDOWN = 1.5
+# POLITENESS_MAX_ERROR_RATE = 0.02
+# POLITENESS_MIN_BASELINE = 0.01
+
 # Enable and configure the AutoThrottle extension (disabled by default)
 # See https://docs.scrapy.org/en/latest/topics/autothrottle.html
 # AUTOTHROTTLE_ENABLED = True
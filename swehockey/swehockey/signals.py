@@ -0,0 +1,13 @@
+# Custom signals of the swehockey project.
+#
+# See https://docs.scrapy.org/en/latest/topics/signals.html
+
+# Sent by the stats spider when a GamesByDate page has been parsed.
+# Arguments: date (YYYY-MM-DD) and game_ids, the swehockey ids of
+# the games requested from the page.
+date_parsed = object()
+
+# Sent by the stats spider when a game events page shows that the game
+# has ended, and for its line up page once both pages are parsed.
+# Arguments: response, the events or line up page, and swehockey_id.
+game_finished = object()
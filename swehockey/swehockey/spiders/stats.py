@@ -1,79 +1,425 @@
 import scrapy
+from scrapy import signals
+from scrapy.exceptions import DontCloseSpider
+from scrapy.http import HtmlResponse
+from scrapy.utils.job import job_dir
+from swehockey.pipelines import DB_PATH, load_checkpoints, load_game_ids
+from swehockey.profiling import timed
+from swehockey.signals import date_parsed, game_finished
+from swehockey.state import MAX_MEMORY, GameStateStore
+from swehockey.corpus import page_kind
+from swehockey.parsers import parse_event_rows, parse_line, parse_shootout_row
+from swehockey.xpaths import XPATHS, nodes, values
 from swehockey.items import (
     BasicStatsItem,
     EventItem,
-    ShootoutItem,
+    LiveGameItem,
     LineupItem,
-    LineItem,
     EventItemLoader,
     clean,
     clean_list,
 )
 from scrapy.loader import ItemLoader
 from itemloaders.processors import TakeFirst, MapCompose
+from datetime import date, timedelta
+from urllib.parse import urlsplit
+import os
 import re
 import logging
+import time
 
 
 START_DATE = "2014-01-01"
 END_DATE = "2014-02-01"
 
+# Fields read from the game summary table of the events page,
+# each with an XPath of the same name in XPATHS.
+SUMMARY_FIELDS = [
+    "date_time",
+    "league",
+    "arena",
+    "shots_total_team_1",
+    "shots_total_team_2",
+    "saves_total_team_1",
+    "saves_total_team_2",
+    "pim_total_team_1",
+    "pim_total_team_2",
+    "shots_by_period_team_1",
+    "shots_by_period_team_2",
+    "saves_by_period_team_1",
+    "saves_by_period_team_2",
+    "pim_by_period_team_1",
+    "pim_by_period_team_2",
+    "pp_time_team_1",
+    "pp_time_team_2",
+    "pp_perc_team_1",
+    "pp_perc_team_2",
+    "spectators",
+    "score",
+    "score_by_period",
+]
+
+
+# Priority of the events and line up page requests, above the date and
+# schedule pages (0), so that the pages of the games found so far are
+# not queued behind the date pages still to come. Retried pages are
+# lowered by RETRY_PRIORITY_ADJUST, to the level of the date pages.
+GAME_PAGE_PRIORITY = 1
+
+# Polling of games in progress with LIVE_CRAWL: the events page is
+# requested again after the minimum interval (seconds) when it changed
+# since the last poll, and after twice the last interval, up to the
+# maximum, when it did not. Games still not finished after
+# LIVE_POLL_HOURS are given up.
+LIVE_POLL_MIN_INTERVAL = 30
+LIVE_POLL_MAX_INTERVAL = 300
+LIVE_POLL_HOURS = 6
+
+
+class PendingGame:
+    # A game whose events and line up pages are requested together.
+    # events is None until the events page is parsed into the item,
+    # then True if the game finished, else False. lineup is None until
+    # the line up page is parsed, then the LineupItem (False if the
+    # page failed). queued holds the pages ("events", "lineups") whose
+    # requests have not come back yet: the game is only joined once it
+    # is empty. unchanged holds the pages flagged by PageHashMiddleware
+    # as (url, body, encoding) by kind, until the game is joined.
+    # since is when the first of the pages came in.
+    # The line up response is only kept for the game_finished signal,
+    # and is left out when the game is spilled to disk.
+    #
+    # Games in progress are polled with LIVE_CRAWL. polls is the number
+    # of polls so far, live_events the game events and totals the
+    # summary last yielded in a LiveGameItem, and interval the current
+    # polling interval.
+
+    __slots__ = (
+        "item",
+        "events",
+        "lineup",
+        "lineup_response",
+        "since",
+        "queued",
+        "unchanged",
+        "polls",
+        "live_events",
+        "totals",
+        "interval",
+    )
+
+    def __init__(self, item):
+        self.item = item
+        self.events = None
+        self.lineup = None
+        self.lineup_response = None
+        self.since = None
+        self.queued = {"events", "lineups"}
+        self.unchanged = {}
+        self.polls = 0
+        self.live_events = []
+        self.totals = None
+        self.interval = None
+
+    def __getstate__(self):
+        return tuple(
+            getattr(self, name)
+            for name in self.__slots__
+            if name != "lineup_response"
+        )
+
+    def __setstate__(self, state):
+        names = [name for name in self.__slots__ if name != "lineup_response"]
+        for name, value in zip(names, state):
+            setattr(self, name, value)
+        self.lineup_response = None
+
+
+def date_range(start, end):
+    # Yield every date from start up to, but not including,
+    # end as an ISO formatted string (YYYY-MM-DD).
+    day = date.fromisoformat(start)
+    end = date.fromisoformat(end)
+    while day < end:
+        yield day.isoformat()
+        day += timedelta(days=1)
+
 
 class StatsSpider(scrapy.Spider):
     name = "stats"
     allowed_domains = ["stats.swehockey.se"]
-    start_urls = [f"https://stats.swehockey.se/GamesByDate/{START_DATE}"]
+    base_url = "https://stats.swehockey.se"
+
+    def __init__(
+        self,
+        start=START_DATE,
+        end=END_DATE,
+        leagues=None,
+        schedules=None,
+        *args,
+        **kwargs,
+    ):
+        # Spider arguments:
+        #   -a start=YYYY-MM-DD -a end=YYYY-MM-DD  dates to scrape, end
+        #       not included (default: START_DATE and END_DATE).
+        #   -a leagues=SHL,HockeyAllsvenskan  only scrape games from
+        #       these leagues (default: all leagues).
+        #   -a schedules=3905,3906  find the games on these season
+        #       schedule pages (/ScheduleAndResults/Schedule/<id>, one
+        #       per league and season) instead of on the date pages.
+        #       All games of the schedules are scraped. The date pages
+        #       from start to end are still walked if a schedule page
+        #       fails or lists no games.
+        #   -a base_url=...  e.g. to crawl a local mock server
+        #       (see mockserver.py).
+        super().__init__(*args, **kwargs)
+        self.start_date = date.fromisoformat(start).isoformat()
+        self.end_date = date.fromisoformat(end).isoformat()
+        self.leagues = (
+            {clean(league).lower() for league in leagues.split(",")}
+            if leagues
+            else None
+        )
+        self.schedules = schedules.split(",") if schedules else []
+        self.base_url = self.base_url.rstrip("/")
+        self.allowed_domains = [urlsplit(self.base_url).hostname]
+        # Dates whose page has already been requested.
+        self.scheduled_dates = set()
+        # Games whose pages have already been requested.
+        self.scheduled_games = set()
+        # Games already in the database, skipped in incremental mode.
+        self.known_games = set()
+        # Dates completed by an earlier run, skipped when resuming.
+        self.completed_dates = set()
+        # PendingGames by swehockey id, whose events and line up pages
+        # are not both parsed yet (see state.py).
+        self.pending_games = GameStateStore()
+        # Scheduled polls of games in progress (see LIVE_CRAWL).
+        self.live_polls = {}
+
+    @classmethod
+    def from_crawler(cls, crawler, *args, **kwargs):
+        spider = super().from_crawler(crawler, *args, **kwargs)
+        crawler.signals.connect(
+            spider.spider_opened, signal=signals.spider_opened
+        )
+        crawler.signals.connect(spider.spider_idle, signal=signals.spider_idle)
+        return spider
+
+    def spider_opened(self, spider):
+        if self.settings.getbool("PROFILE"):
+            # Called from parse_stats_summary rather than as a callback,
+            # so ProfilingMiddleware does not see it.
+            self.parse_game_actions = timed(
+                self.parse_game_actions, self.crawler.stats, "parse_game_actions"
+            )
+        db_path = self.settings.get("SQLITE_DB_PATH", DB_PATH)
+        if self.settings.getbool("INCREMENTAL_CRAWL"):
+            self.known_games = load_game_ids(db_path)
+            logging.info(
+                f"Incremental crawl: skipping {len(self.known_games)} games already in the database."
+            )
+        if self.settings.getbool("RESUME_CRAWL"):
+            # Continue where an interrupted crawl stopped: skip the
+            # dates and games it already completed.
+            self.completed_dates = load_checkpoints(db_path, "date")
+            self.known_games |= load_checkpoints(db_path, "game")
+            logging.info(
+                f"Resuming crawl: {len(self.completed_dates)} dates completed by earlier runs."
+            )
+        # Spill pending games to disk, and keep them across restarts
+        # of a crawl with a JOBDIR.
+        jobdir = job_dir(self.settings)
+        path = self.settings.get("GAME_STATE_PATH") or (
+            jobdir and os.path.join(jobdir, "game_state.db")
+        )
+        if path:
+            self.pending_games = GameStateStore(
+                path,
+                max_memory=self.settings.getint("GAME_STATE_MEMORY_GAMES", MAX_MEMORY),
+                persist=bool(jobdir),
+            )
+            if len(self.pending_games):
+                logging.info(f"Continuing {len(self.pending_games)} pending games.")
+                self.restore_games()
+
+    def restore_games(self):
+        # Pick up the games pending when a crawl with a JOBDIR was paused.
+        # Their queued pages are still in the JOBDIR request queue, but
+        # the next poll of the games in progress has to be scheduled
+        # again. Pages that were downloading at the pause are lost; their
+        # games are dropped in spider_idle().
+        for swehockey_id, game in self.pending_games.items():
+            if game.polls and "events" in game.queued:
+                self.schedule_poll(swehockey_id, 0, game.item["event_url"], {})
+                self.crawler.stats.inc_value("live/restored_polls")
+
+    def closed(self, reason):
+        for call in self.live_polls.values():
+            call.cancel()
+        self.pending_games.close()
+
+    def start_requests(self):
+        if not self.schedules:
+            yield from self.date_requests()
+            return
+        for schedule in self.schedules:
+            if f"schedule {schedule}" in self.completed_dates:
+                continue
+            yield scrapy.Request(
+                url=f"{self.base_url}/ScheduleAndResults/Schedule/{schedule}",
+                callback=self.parse_schedule,
+                errback=self.schedule_failed,
+                cb_kwargs={"schedule": schedule},
+            )
+
+    def date_requests(self):
+        # Schedule the date page of every day in the range up front,
+        # so that they are downloaded concurrently rather than by
+        # walking the ">>" link from one day to the next.
+        for day in date_range(self.start_date, self.end_date):
+            if day in self.scheduled_dates:
+                continue
+            self.scheduled_dates.add(day)
+            if (
+                day in self.completed_dates
+                or self.checkpoint_key(day) in self.completed_dates
+            ):
+                continue
+            yield scrapy.Request(
+                url=f"{self.base_url}/GamesByDate/{day}", callback=self.parse
+            )
+
+    async def start(self):
+        # Scrapy >= 2.13 uses start() instead of start_requests().
+        for request in self.start_requests():
+            yield request
 
     def parse(self, response):
         # Retrieve URL to each game a page
-        for game in response.xpath(
-            "//table[@class='tblContent']/tr/td/a[starts-with(@href, 'java')]"
-        ):
-            # Create Loader object
-            l = EventItemLoader(item=BasicStatsItem(), selector=game)
-            l.default_output_processor = TakeFirst()
+        game_ids = []
+        for game in nodes(response.selector, XPATHS["game_links"]):
+            if self.leagues and not self.in_leagues(game):
+                self.crawler.stats.inc_value("leagues/skipped_games")
+                continue
+            yield from self.follow_game(response, game, game_ids)
 
-            # Extract URLs and game ID.
-            game_link = game.xpath(".//@href").get()
-            event_url = game_link.split("'")[1]
-            swehockey_id = event_url.split("/")[3]
-            line_up_url = f"/Game/LineUps/{swehockey_id}"
+        # Let the pipeline checkpoint the date once all games are stored.
+        kind, day = page_kind(response.url)
+        if kind == "date":
+            self.crawler.signals.send_catch_log(
+                signal=date_parsed,
+                date=self.checkpoint_key(day),
+                game_ids=game_ids,
+            )
 
-            l.add_value("swehockey_id", swehockey_id)
-            l.add_value("event_url", response.urljoin(event_url))
-            l.add_value("line_up_url", response.urljoin(line_up_url))
+        # All date pages are scheduled in start_requests. The ">>" link
+        # (i.e. next day's games) is only followed as a fallback, in case
+        # it points to a date in the range that was not scheduled.
+        next_page_url = values(response.selector, XPATHS["next_page_url"])
+        next_page_text = values(response.selector, XPATHS["next_page_text"])
+        if not next_page_url or not next_page_text:
+            return
 
-            # Open Game Event link
-            yield response.follow(
-                url=event_url,
-                callback=self.parse_stats_summary,
-                cb_kwargs={
-                    "swehockey_id": swehockey_id,
-                    "line_up_url": line_up_url,
-                    "item": l.load_item(),
-                },
+        next_page_date = clean(next_page_text[0].replace(">>", ""))
+        if (
+            self.start_date <= next_page_date < self.end_date
+            and next_page_date not in self.scheduled_dates
+        ):
+            logging.warning(
+                f"Date {next_page_date} missing from the date range, following link. URL: {response.url}"
             )
+            self.scheduled_dates.add(next_page_date)
+            yield response.follow(url=next_page_url[0], callback=self.parse)
 
-        # Find and navigate to next page of games (i.e. next day's games).
-        next_page_url = response.xpath(
-            "//div[@class='form-group btn-group']/a[2]/@href"
-        ).get()
-
-        next_page_date = int(
-            clean(
-                response.xpath(
-                    "//div[@class='form-group btn-group']/a[2]/text()"
-                )
-                .get()
-                .replace(">>", "")
-                .replace("-", "")
+    def parse_schedule(self, response, schedule):
+        # Find the games on a season schedule page. Games are linked
+        # from their result, the same way as on the date pages.
+        game_ids = []
+        games = nodes(response.selector, XPATHS["schedule_game_links"])
+        if not games:
+            logging.warning(
+                f"No games found on schedule {schedule}, walking the date pages instead. URL: {response.url}"
             )
+            yield from self.date_requests()
+            return
+        for game in games:
+            yield from self.follow_game(response, game, game_ids)
+        logging.info(f"Schedule {schedule}: {len(game_ids)} games to scrape.")
+
+        # Checkpointed like a date, once all its games are stored.
+        self.crawler.signals.send_catch_log(
+            signal=date_parsed,
+            date=f"schedule {schedule}",
+            game_ids=game_ids,
         )
-        if next_page_date < int(END_DATE.replace("-", "")):
-            yield response.follow(url=next_page_url, callback=self.parse)
 
-    def parse_stats_summary(self, response, swehockey_id, line_up_url, item):
-        game_info = response.xpath("(//table[@class='tblContent'])[1]")
+    def schedule_failed(self, failure):
+        logging.warning(
+            f"Failed to download schedule: {failure.value!r}, walking the date pages instead. URL: {failure.request.url}"
+        )
+        yield from self.date_requests()
+
+    def follow_game(self, response, game, game_ids):
+        # Request the pages of the game linked from a date or schedule
+        # page, and add its id to game_ids.
+        # Create Loader object
+        l = EventItemLoader(item=BasicStatsItem(), selector=game)
+        l.default_output_processor = TakeFirst()
+
+        # Extract URLs and game ID, from links like
+        # javascript:openonlinewindow('/Game/Events/123456','')
+        game_link = values(game, XPATHS["game_link_href"])[0]
+        event_url = re.search(r"/Game/Events/\d+", game_link).group()
+        swehockey_id = event_url.split("/")[3]
+        if swehockey_id in self.known_games:
+            self.crawler.stats.inc_value("incremental/skipped_games")
+            return
+        line_up_url = f"/Game/LineUps/{swehockey_id}"
+        game_ids.append(swehockey_id)
+        if swehockey_id in self.scheduled_games:
+            # Listed on an earlier date page too.
+            return
+        self.scheduled_games.add(swehockey_id)
+
+        l.add_value("swehockey_id", swehockey_id)
+        l.add_value("event_url", response.urljoin(event_url))
+        l.add_value("line_up_url", response.urljoin(line_up_url))
+        self.pending_games[swehockey_id] = PendingGame(l.load_item())
+
+        # Request the events and line up pages together. The item
+        # is yielded once both are parsed, see join_game().
+        for url, callback in (
+            (event_url, self.parse_stats_summary),
+            (line_up_url, self.parse_line_up),
+        ):
+            yield response.follow(
+                url=url,
+                callback=callback,
+                errback=self.game_page_failed,
+                cb_kwargs={"swehockey_id": swehockey_id},
+                priority=GAME_PAGE_PRIORITY,
+            )
+
+    def parse_stats_summary(self, response, swehockey_id, item=None):
+        # Parse the events page of a game into its item. The item is
+        # yielded by join_game() once the line up is parsed too. The
+        # item can be given when calling this outside of a crawl.
+        game = self.pending_game(swehockey_id, "events", item)
+        if game is None:
+            return
+        if "unchanged" in response.flags:
+            yield from self.hold_unchanged(swehockey_id, game, "events", response)
+            return
+        if response.status == 304:
+            # A game in progress, unchanged since the last poll.
+            yield from self.poll_game(
+                swehockey_id, game, response.url, response.request.headers, False
+            )
+            return
+        # Polled games are parsed again into a fresh copy.
+        item = game.item.copy()
+        game_info = nodes(response.selector, XPATHS["game_info"])
         l = EventItemLoader(item=item, selector=game_info)
         l.default_output_processor = TakeFirst()
         l.default_input_processor = MapCompose(clean)
@@ -86,17 +432,28 @@ class StatsSpider(scrapy.Spider):
             "Game Winning Shots ended",
         ]
         game_status = clean(
-            response.xpath("//td[@class='tdInfoArea']/div[3]/text()").get()
+            next(iter(values(response.selector, XPATHS["game_status"])), "")
         )
 
-        if not any(txt in game_status for txt in game_ended_strings):
+        finished = any(txt in game_status for txt in game_ended_strings)
+        if not finished and not self.settings.getbool("LIVE_CRAWL"):
             logging.warning(
                 f"Game not finished or invalid. URL: https://stats.swehockey.se/Game/Events/{swehockey_id}\nStatus: '{game_status}'"
             )
+            game.events = False
+            yield from self.join_game(swehockey_id)
             return
+        if finished:
+            self.crawler.signals.send_catch_log(
+                signal=game_finished, response=response, swehockey_id=swehockey_id
+            )
+        elif not game.polls:
+            logging.info(
+                f"Game {swehockey_id} in progress, polling it. Status: '{game_status}'"
+            )
 
         # Parse basic game stats
-        title = clean(response.xpath("//title/text()").get())
+        title = clean(values(response.selector, XPATHS["title"])[0])
         team_names_abbrev = clean_list(title.split("-", 1))
         l.add_value(
             "home_name_abbrev",
@@ -106,96 +463,152 @@ class StatsSpider(scrapy.Spider):
             "away_name_abbrev",
             clean_list(team_names_abbrev[1].split("(", 1))[0],
         )
-        teams = game_info.xpath("//tr/th/h2/text()").get()
+        teams = values(game_info, XPATHS["teams"])[0]
         teams = clean_list([clean(team) for team in teams.split("-")])
         l.add_value("home_name", teams[0])
         l.add_value("away_name", teams[1])
-        l.add_xpath("date_time", ".//tr[2]/td[1]/h3/text()")
-        l.add_xpath("league", ".//tr[2]/td[2]/h3/text()")
-        l.add_xpath("arena", ".//tr[2]/td[3]/h3/b/text()")
-        l.add_xpath("shots_total_team_1", self.stats_total_xpath(3, 2))
-        l.add_xpath("shots_total_team_2", self.stats_total_xpath(3, 6))
-        l.add_xpath("saves_total_team_1", self.stats_total_xpath(5, 2))
-        l.add_xpath("saves_total_team_2", self.stats_total_xpath(5, 5))
-        l.add_xpath("pim_total_team_1", self.stats_total_xpath(7, 2))
-        l.add_xpath("pim_total_team_2", self.stats_total_xpath(7, 6))
-        l.add_xpath("shots_by_period_team_1", self.stats_by_period_xpath(3, 3))
-        l.add_xpath("shots_by_period_team_2", self.stats_by_period_xpath(3, 7))
-        l.add_xpath("saves_by_period_team_1", self.stats_by_period_xpath(5, 3))
-        l.add_xpath("saves_by_period_team_2", self.stats_by_period_xpath(5, 6))
-        l.add_xpath("pim_by_period_team_1", self.stats_by_period_xpath(7, 3))
-        l.add_xpath("pim_by_period_team_2", self.stats_by_period_xpath(7, 7))
-        l.add_xpath("pp_time_team_1", self.stats_by_period_xpath(8, 3))
-        l.add_xpath("pp_time_team_2", self.stats_by_period_xpath(8, 6))
-        l.add_xpath("pp_perc_team_1", ".//tr[8]/td[2]/strong/text()")
-        l.add_xpath("pp_perc_team_2", ".//tr[8]/td[5]/strong/text()")
-        l.add_xpath("spectators", ".//td[@class='tdInfoArea']/div[4]/text()")
-        l.add_xpath("score", "//td[@class='tdInfoArea']/div[1]/text()")
-        l.add_xpath(
-            "score_by_period", "//td[@class='tdInfoArea']/div[2]/text()"
+        for field in SUMMARY_FIELDS:
+            l.add_xpath(field, XPATHS[field])
+
+        if not finished:
+            yield from self.parse_live(response, swehockey_id, game, l.load_item())
+            return
+
+        game.item = self.parse_game_actions(response, swehockey_id, l.load_item())
+        game.events = True
+        if game.polls:
+            # The line up was downloaded before the game ended.
+            logging.info(f"Game {swehockey_id} finished after {game.polls} polls.")
+            game.lineup = None
+            game.queued.add("lineups")
+            yield response.follow(
+                url=game.item["line_up_url"],
+                callback=self.parse_line_up,
+                errback=self.game_page_failed,
+                cb_kwargs={"swehockey_id": swehockey_id},
+                dont_filter=True,
+                priority=GAME_PAGE_PRIORITY,
+            )
+        yield from self.join_game(swehockey_id)
+
+    def parse_live(self, response, swehockey_id, game, item):
+        # Yield the game events of a game in progress with its current
+        # summary as a LiveGameItem, if either changed since the last
+        # poll. All the events are yielded and replace the stored ones,
+        # since events can be corrected or removed during the game, not
+        # only added.
+        events = nodes(response.selector, XPATHS["events_table"])
+        actions = nodes(events, XPATHS["event_rows"])
+        if self.settings.getbool("FAST_EVENT_PARSER"):
+            game_events = parse_event_rows(action.root for action in actions)
+        else:
+            game_events = [self.load_game_event(action) for action in actions]
+        totals = tuple(repr(item.get(field)) for field in SUMMARY_FIELDS)
+        changed = game_events != game.live_events or totals != game.totals
+        if changed:
+            self.crawler.stats.inc_value("live/updates")
+            self.crawler.stats.inc_value(
+                "live/events", max(len(game_events) - len(game.live_events), 0)
+            )
+            yield LiveGameItem(item, game_events=game_events)
+            game.live_events = game_events
+            game.totals = totals
+
+        validators = {
+            "If-None-Match": response.headers.get("ETag"),
+            "If-Modified-Since": response.headers.get("Last-Modified"),
+        }
+        yield from self.poll_game(
+            swehockey_id, game, response.url, validators, changed
         )
 
-        self.parse_game_actions(response, swehockey_id, l.load_item())
+    def poll_game(self, swehockey_id, game, url, headers, changed):
+        # Request the events page of a game in progress again later,
+        # conditional on the ETag and Last-Modified of the last full
+        # response (the If-None-Match and If-Modified-Since of headers).
+        hours = self.settings.getfloat("LIVE_POLL_HOURS", LIVE_POLL_HOURS)
+        if time.time() - game.since > hours * 3600:
+            logging.warning(
+                f"Game {swehockey_id} not finished after {hours} hours, giving up."
+            )
+            game.events = False
+            yield from self.join_game(swehockey_id)
+            return
 
-        # Open Game Event link
-        yield response.follow(
-            url=line_up_url,
-            callback=self.parse_line_up,
-            cb_kwargs={"swehockey_id": swehockey_id, "item": l.load_item()},
+        minimum = self.settings.getfloat("LIVE_POLL_MIN_INTERVAL", LIVE_POLL_MIN_INTERVAL)
+        maximum = self.settings.getfloat("LIVE_POLL_MAX_INTERVAL", LIVE_POLL_MAX_INTERVAL)
+        if changed or game.interval is None:
+            game.interval = minimum
+        else:
+            game.interval = min(game.interval * 2, maximum)
+        game.polls += 1
+        game.queued.add("events")
+        self.crawler.stats.inc_value("live/polls")
+        self.schedule_poll(swehockey_id, game.interval, url, headers)
+
+    def schedule_poll(self, swehockey_id, delay, url, headers):
+        from twisted.internet import reactor
+
+        request = scrapy.Request(
+            url=url,
+            callback=self.parse_stats_summary,
+            errback=self.game_page_failed,
+            cb_kwargs={"swehockey_id": swehockey_id},
+            headers={
+                name: headers.get(name)
+                for name in ("If-None-Match", "If-Modified-Since")
+                if headers.get(name)
+            },
+            meta={"handle_httpstatus_list": [304]},
+            dont_filter=True,
+            priority=GAME_PAGE_PRIORITY,
+        )
+        # A poll restored from the JOBDIR request queue (see
+        # restore_games()) may come back while another one is scheduled.
+        previous = self.live_polls.pop(swehockey_id, None)
+        if previous is not None:
+            previous.cancel()
+        self.live_polls[swehockey_id] = reactor.callLater(
+            delay, self.send_poll, swehockey_id, request
         )
 
+    def send_poll(self, swehockey_id, request):
+        del self.live_polls[swehockey_id]
+        self.crawler.engine.crawl(request)
+
     def parse_game_actions(self, response, swehockey_id, item):
-        events = response.xpath("(//table[@class='tblContent'])[2]")
+        events = nodes(response.selector, XPATHS["events_table"])
         l = EventItemLoader(item=item, selector=events)
-        l.add_xpath("goalies_teams", self.get_goalies_xpath(3))
-        l.add_xpath("goalies_names", self.get_goalies_xpath(4))
-        l.add_xpath("goalies_saves", self.get_goalies_xpath(5))
+        l.add_xpath("goalies_teams", XPATHS["goalies_teams"])
+        l.add_xpath("goalies_names", XPATHS["goalies_names"])
+        l.add_xpath("goalies_saves", XPATHS["goalies_saves"])
 
         # Find the last period of the game (including overtime) and extract data from each period
-        actions = events.xpath(
-            "(.//tr/th/h3[contains(text(), 'Overtime') or contains(text(), 'overtime') or contains(text(), '3rd period') or contains(text(), '2nd period') or contains(text(), '1st period') ])[1]/ancestor::node()/following-sibling::tr[not(.//th)]"
-        )
+        actions = nodes(events, XPATHS["event_rows"])
 
         if not actions:
             logging.warning(
                 f"No game events found. Possible irregularity in html. URL: https://stats.swehockey.se/Game/Events/{swehockey_id}"
             )
-        for action in actions:
-            el = EventItemLoader(item=EventItem(), selector=action)
-            el.add_xpath("time", ".//td[1]/text()")
-            el.add_xpath("event", ".//td[2]/text()")
-            el.add_xpath("team", ".//td[3]/text()")
-            el.add_xpath("player", ".//td[4]/text()")
-            el.add_xpath(
-                "assist_1", ".//td[4]/descendant-or-self::div[1]/text()"
-            )
-            el.add_xpath(
-                "assist_2", ".//td[4]/descendant-or-self::div[2]/text()"
-            )
-            el.add_xpath("details_1", ".//td[5]/descendant-or-self::text()[1]")
-            el.add_xpath("details_2", ".//td[5]/descendant-or-self::text()[2]")
-            l.add_value("game_events", el.load_item())
+        if self.settings.getbool("FAST_EVENT_PARSER"):
+            game_events = parse_event_rows(action.root for action in actions)
+        else:
+            game_events = [self.load_game_event(action) for action in actions]
+        for event in game_events:
+            l.add_value("game_events", event)
 
         # Get shootout data (if any)
-        shootout_actions = response.xpath(
-            "((//table[@class='tblContent'])[2]/tr/th/h3[contains(text(), 'Game Winning Shots')])[1]/ancestor::tr[1]/following-sibling::tr/th/ancestor::tr[1]/preceding-sibling::tr/td/div[contains(text(), 'vs. goalie')]/ancestor::tr[1]"
-        )
+        shootout_actions = nodes(response.selector, XPATHS["shootout_rows"])
         if shootout_actions:
             for action in shootout_actions:
-                sl = EventItemLoader(item=ShootoutItem(), selector=action)
-                sl.add_xpath("scored", ".//td[1]/text()")
-                sl.add_xpath("score", ".//td[2]/text()")
-                sl.add_xpath("team", ".//td[3]/text()")
-                sl.add_xpath("player", ".//td[4]//div[1]/text()")
-                sl.add_xpath("goalie", ".//td[4]//div[2]/text()")
-                l.add_value("shootout_events", sl.load_item())
+                l.add_value("shootout_events", parse_shootout_row(action.root))
         else:
             l.add_value(
                 "shootout_events", ""
             )  # Create an empty field even if there is no shootout
         return l.load_item()
 
-    def parse_line_up(self, response, swehockey_id, item):
+    def parse_line_up(self, response, swehockey_id, item=None):
         # Parse the line up page to get data on
         # participating refs, coaches, and players.
 
@@ -205,73 +618,214 @@ class StatsSpider(scrapy.Spider):
         # the first and last names without some sort of cross reference,
         # since some have multiple last names and some have multiple
         # first names.
-        lineup_selector = response.xpath("(//table[@class='tblContent'])[2]")
-        l = EventItemLoader(item=item)
+        game = self.pending_game(swehockey_id, "lineups", item)
+        if game is None:
+            return
+        if "unchanged" in response.flags:
+            yield from self.hold_unchanged(swehockey_id, game, "lineups", response)
+            return
+        lineup_selector = nodes(response.selector, XPATHS["lineup_table"])
         ll = EventItemLoader(item=LineupItem(), selector=lineup_selector)
-        ll.add_xpath(
-            "refs", "(.//table[@class='tblContent'])[1]//tr[1]/td[2]/text()"
-        )
-        ll.add_xpath(
-            "linesmen",
-            "(.//table[@class='tblContent'])[1]//tr[2]/td[2]/text()",
-        )
-        ll.add_xpath(
-            "home_team_coaches",
-            "(.//table[@class='tblContent'])[2]//tr[3]/td[2]/table/tr/td/text()",
-        )
-        ll.add_xpath(
-            "away_team_coaches",
-            "(.//table[@class='tblContent'])[2]//tr[3]/following-sibling::tr[last()]//table/tr/td/text()",
-        )
+        ll.add_xpath("refs", XPATHS["refs"])
+        ll.add_xpath("linesmen", XPATHS["linesmen"])
+        ll.add_xpath("home_team_coaches", XPATHS["home_team_coaches"])
+        ll.add_xpath("away_team_coaches", XPATHS["away_team_coaches"])
 
         self.get_lines(
             lineup_selector,
-            "((//table[@class='tblContent'])[4]//tr/th[contains(@class, 'tdSubTitle')])[2]/ancestor::tr[1]/preceding-sibling::tr/descendant::*[contains(@style, 'text-align')]/ancestor::tr[1]",
+            XPATHS["lineup_home"],
             ll.load_item(),
             "lineup_home",
             swehockey_id,
         )
         self.get_lines(
             lineup_selector,
-            "((//table[@class='tblContent'])[4]//tr/th[contains(@class, 'tdSubTitle')])[2]/ancestor::tr[1]/following-sibling::tr/td[contains(@style, 'text-align')]/ancestor::tr[1]",
+            XPATHS["lineup_away"],
             ll.load_item(),
             "lineup_away",
             swehockey_id,
         )
 
-        l.add_value("lineup", ll.load_item())
-        yield l.load_item()
+        game.lineup = ll.load_item()
+        game.lineup_response = response
+        yield from self.join_game(swehockey_id)
+
+    def pending_game(self, swehockey_id, kind, item=None):
+        # The PendingGame the page of the given kind belongs to, which is
+        # no longer queued. Pages of games that are not pending, e.g.
+        # that were dropped, are ignored.
+        game = self.pending_games.get(swehockey_id)
+        if game is None:
+            if item is None:
+                self.crawler.stats.inc_value("game_join/late_pages")
+                return None
+            game = self.pending_games[swehockey_id] = PendingGame(item)
+        game.queued.discard(kind)
+        if game.since is None:
+            game.since = time.time()
+        return game
+
+    def game_page_failed(self, failure):
+        # Errback of the events and line up requests, e.g. for a 404.
+        request = failure.request
+        swehockey_id = request.cb_kwargs["swehockey_id"]
+        kind = page_kind(request.url)[0]
+        logging.warning(
+            f"Failed to download game page: {failure.value!r}. URL: {request.url}"
+        )
+        game = self.pending_game(swehockey_id, kind)
+        if game is None:
+            return
+        if kind == "events" and game.polls:
+            # Keep polling a game in progress.
+            yield from self.poll_game(
+                swehockey_id, game, request.url, request.headers, False
+            )
+            return
+        if kind == "events":
+            game.events = False
+        else:
+            game.lineup = False
+        yield from self.join_game(swehockey_id)
+
+    def join_game(self, swehockey_id):
+        # Yield the item of a game once none of its pages is queued any
+        # more. A retried page can take long to come back in a large
+        # crawl, so there is no time limit: pages that never come back,
+        # e.g. because their request was dropped, are dealt with in
+        # spider_idle().
+        game = self.pending_games.get(swehockey_id)
+        if game.queued:
+            return
+        if game.unchanged:
+            yield from self.join_unchanged(swehockey_id, game)
+            return
+        yield from self.finish_game(swehockey_id)
+
+    def hold_unchanged(self, swehockey_id, game, kind, response):
+        # The game is stored, and this page has not changed since (see
+        # PageHashMiddleware). Keep the page unparsed until the game is
+        # joined.
+        game.unchanged[kind] = (response.url, response.body, response.encoding)
+        yield from self.join_game(swehockey_id)
+
+    def join_unchanged(self, swehockey_id, game):
+        # A stored game with an unchanged page is dropped, unless its
+        # other page changed. Then the pipeline stores the game again,
+        # which needs the unchanged page parsed too, so it is parsed
+        # now. Its callback joins the game again.
+        changed = (
+            "events" not in game.unchanged and game.events
+        ) or (
+            "lineups" not in game.unchanged
+            and game.lineup is not None
+            and game.lineup is not False
+        )
+        if not changed:
+            self.pending_games.pop(swehockey_id)
+            self.crawler.stats.inc_value("page_hash/skipped_games")
+            return
+        self.crawler.stats.inc_value("page_hash/parsed_unchanged")
+        kind, (url, body, encoding) = game.unchanged.popitem()
+        response = HtmlResponse(url=url, body=body, encoding=encoding)
+        if kind == "events":
+            yield from self.parse_stats_summary(response, swehockey_id)
+        else:
+            yield from self.parse_line_up(response, swehockey_id)
+
+    def finish_game(self, swehockey_id):
+        # Games that did not finish, or whose events page failed, are
+        # dropped. If only the line up is missing, the item is yielded
+        # without one if GAME_JOIN_PARTIAL_ITEMS is set, so that the
+        # rest of the game is stored, and dropped otherwise, so that a
+        # later crawl fetches it again.
+        game = self.pending_games.get(swehockey_id)
+        if game.events is None or game.lineup is None:
+            return
+        self.pending_games.pop(swehockey_id)
+        if not game.events:
+            return
+        if game.lineup is not False:
+            if game.lineup_response is not None:
+                self.crawler.signals.send_catch_log(
+                    signal=game_finished,
+                    response=game.lineup_response,
+                    swehockey_id=swehockey_id,
+                )
+            game.item["lineup"] = game.lineup
+            yield game.item
+            return
+        self.crawler.stats.inc_value("game_join/partial")
+        if not self.settings.getbool("GAME_JOIN_PARTIAL_ITEMS"):
+            logging.warning(f"Game {swehockey_id} dropped: no line up.")
+            return
+        logging.warning(f"Game {swehockey_id} stored without line up.")
+        game.item["lineup"] = LineupItem({field: "" for field in LineupItem.fields})
+        yield game.item
 
-    def stats_total_xpath(self, tr, td):
-        return f".//tr[{tr}]/td[{td}]/strong/text()"
+    def spider_idle(self, spider):
+        # Wait for the next poll of the games in progress.
+        if self.live_polls:
+            raise DontCloseSpider
+        # Nothing is queued any more, so no more pages will come in for
+        # the games still pending, e.g. because their requests were
+        # dropped as duplicates.
+        if len(self.pending_games):
+            logging.warning(
+                f"{len(self.pending_games)} games dropped: missing a page."
+            )
+            self.crawler.stats.inc_value(
+                "game_join/incomplete", len(self.pending_games)
+            )
+        self.pending_games.clear()
 
-    def stats_by_period_xpath(self, tr, td):
-        return f".//tr[{tr}]/td[{td}]/text()"
+    def in_leagues(self, game):
+        # Check whether a game link on a date page belongs to one of the
+        # leagues to scrape. The league is looked for in the cells of
+        # the game's row and in the closest header row above it,
+        # ignoring anything after a comma (e.g. "SHL, Regular Season").
+        candidates = values(game, XPATHS["game_row_texts"]) + values(
+            game, XPATHS["game_header_texts"]
+        )
+        return any(
+            clean(text.split(",")[0]).lower() in self.leagues
+            for text in candidates
+        )
 
-    def get_goalies_xpath(self, td):
-        return f"(.//tr/th/h3[contains(text(), 'period') or contains(text(), 'Game Winning Shot') or contains(text(), 'overtime') or contains(text(), 'Overtime')])[1]/ancestor::tr[1]/preceding-sibling::tr/td[{td}]/text()"
-        # return [clean(team.xpath(".//text()").get()) for team in goalies]
+    def checkpoint_key(self, day):
+        # Dates scraped with a league filter are only complete for
+        # those leagues, so the filter is part of their checkpoint.
+        if not self.leagues:
+            return day
+        return f"{day} {','.join(sorted(self.leagues))}"
+
+    def load_game_event(self, action):
+        # Parse one row of the game events table.
+        el = EventItemLoader(item=EventItem(), selector=action)
+        el.add_xpath("time", XPATHS["event_time"])
+        el.add_xpath("event", XPATHS["event_event"])
+        el.add_xpath("team", XPATHS["event_team"])
+        el.add_xpath("player", XPATHS["event_player"])
+        el.add_xpath("assist_1", XPATHS["event_assist_1"])
+        el.add_xpath("assist_2", XPATHS["event_assist_2"])
+        el.add_xpath("details_1", XPATHS["event_details_1"])
+        el.add_xpath("details_2", XPATHS["event_details_2"])
+        return el.load_item()
 
     def get_lines(self, response, line_up_raw, item, line_name, swehockey_id):
         # Parse the line up for one team.
-        line_up_selector = response.xpath(line_up_raw)
+        line_up_selector = nodes(response, line_up_raw)
         ll = EventItemLoader(item=item, selector=line_up_selector)
         if not line_up_selector:
             logging.warning(
                 f"No Line Up found. Possible HTML irregularity. URL: https://stats.swehockey.se/Game/Events/{swehockey_id}"
             )
         for line in line_up_selector:
-            line_loader = EventItemLoader(item=LineItem(), selector=line)
-
-            line_loader.add_xpath("line_name", ".//*/strong/text()")
-            line_loader.add_xpath("players", ".//td/div/text()")
-
-            ll.add_value(line_name, line_loader.load_item())
+            ll.add_value(line_name, parse_line(line.root))
         # NOTE: Starting players are not always indicated except for
         # goaltenders.
         ll.add_xpath(
-            f"starting_players_{line_name}",
-            ".//*[contains(@class, 'red')]/text()",
+            f"starting_players_{line_name}", XPATHS["starting_players"]
         )
 
         return ll.load_item()
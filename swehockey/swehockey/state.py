@@ -0,0 +1,137 @@
+# Store of the state of in-flight games, used by the stats spider.
+#
+# The spider keeps the partial item of every game whose pages are
+# still queued here, keyed by swehockey id, so that its requests only
+# carry the id (and can be kept in JOBDIR disk queues). Games are kept
+# in memory, and with a path, the least recently used ones beyond
+# max_memory are pickled to one sqlite file:
+#
+#     games(swehockey_id, state)
+#
+# A game is moved back into memory when it is looked up, so changes to
+# the returned object are kept. Spilled games are committed as they are
+# spilled, so they survive the crawl being killed. With persist set
+# (under JOBDIR), the games still in memory are written to the file on
+# close, and a paused crawl continues with them when it is resumed.
+# Otherwise the file is emptied when opened.
+
+import pickle
+import sqlite3
+
+# Games kept in memory before they are spilled to the file.
+MAX_MEMORY = 10000
+
+
+class GameStateStore:
+    def __init__(self, path=None, max_memory=MAX_MEMORY, persist=False):
+        self.path = path
+        self.max_memory = max_memory
+        self.persist = persist
+        self.memory = {}
+        self.con = None
+        if path is None:
+            return
+        self.con = sqlite3.connect(path)
+        self.con.execute("PRAGMA journal_mode=WAL")
+        # Commits in WAL mode only sync on checkpoints with NORMAL, so
+        # committing every spill stays cheap.
+        self.con.execute("PRAGMA synchronous=NORMAL")
+        self.con.execute(
+            """CREATE TABLE IF NOT EXISTS games(
+                swehockey_id TEXT PRIMARY KEY,
+                state BLOB NOT NULL
+            )"""
+        )
+        if not persist:
+            self.con.execute("DELETE FROM games")
+        self.con.commit()
+        self.spilled = self.con.execute("SELECT COUNT(*) FROM games").fetchone()[0]
+
+    def __len__(self):
+        return len(self.memory) + (self.spilled if self.con else 0)
+
+    def __contains__(self, swehockey_id):
+        return self.get(swehockey_id, load=False) is not None
+
+    def get(self, swehockey_id, load=True):
+        # Return the state of a game, or None. Unless load is false, a
+        # spilled game is moved back into memory.
+        if swehockey_id in self.memory:
+            state = self.memory.pop(swehockey_id)
+            self.memory[swehockey_id] = state
+            return state
+        if self.con is None:
+            return None
+        row = self.con.execute(
+            "SELECT state FROM games WHERE swehockey_id = ?", (swehockey_id,)
+        ).fetchone()
+        if row is None or not load:
+            return row
+        self.con.execute("DELETE FROM games WHERE swehockey_id = ?", (swehockey_id,))
+        self.spilled -= 1
+        state = pickle.loads(row[0])
+        self[swehockey_id] = state
+        return state
+
+    def __setitem__(self, swehockey_id, state):
+        self.memory.pop(swehockey_id, None)
+        self.memory[swehockey_id] = state
+        if self.con is None:
+            return
+        # A spilled copy would be out of date, and counted twice.
+        if self.spilled:
+            cursor = self.con.execute(
+                "DELETE FROM games WHERE swehockey_id = ?", (swehockey_id,)
+            )
+            self.spilled -= cursor.rowcount
+        # The game just stored stays in memory, so that changes to it
+        # are kept.
+        while len(self.memory) > max(self.max_memory, 1):
+            oldest = next(iter(self.memory))
+            self.spill(oldest, self.memory.pop(oldest))
+        if self.con.in_transaction:
+            self.con.commit()
+
+    def spill(self, swehockey_id, state):
+        # Only called for games in memory, which have no spilled copy.
+        self.con.execute(
+            "INSERT INTO games(swehockey_id, state) VALUES(?, ?)",
+            (swehockey_id, pickle.dumps(state, pickle.HIGHEST_PROTOCOL)),
+        )
+        self.spilled += 1
+
+    def items(self):
+        # All games, without moving spilled ones into memory. Changes to
+        # the spilled ones are not kept.
+        yield from list(self.memory.items())
+        if self.con is None:
+            return
+        rows = self.con.execute("SELECT swehockey_id, state FROM games")
+        for swehockey_id, state in rows.fetchall():
+            yield swehockey_id, pickle.loads(state)
+
+    def pop(self, swehockey_id, default=None):
+        state = self.get(swehockey_id)
+        if state is None:
+            return default
+        del self.memory[swehockey_id]
+        return state
+
+    def clear(self):
+        self.memory.clear()
+        if self.con is not None:
+            self.con.execute("DELETE FROM games")
+            self.spilled = 0
+
+    def close(self):
+        if self.con is None:
+            return
+        if self.persist:
+            for swehockey_id, state in self.memory.items():
+                self.spill(swehockey_id, state)
+        else:
+            self.con.execute("DELETE FROM games")
+        self.memory.clear()
+        self.con.commit()
+        self.con.close()
+        self.con = None
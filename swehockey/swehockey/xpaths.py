@@ -0,0 +1,128 @@
+# Precompiled XPath expressions used by the stats spider.
+#
+# Every expression is compiled once, at import, instead of once per
+# call. Look them up in XPATHS by purpose. Item loaders accept them
+# directly in add_xpath (see EventItemLoader), and nodes() / values()
+# evaluate them on parsel selectors.
+
+from lxml import etree
+from parsel import Selector, SelectorList
+
+
+def stats_total_xpath(tr, td):
+    return f".//tr[{tr}]/td[{td}]/strong/text()"
+
+
+def stats_by_period_xpath(tr, td):
+    return f".//tr[{tr}]/td[{td}]/text()"
+
+
+def goalies_xpath(td):
+    return f"(.//tr/th/h3[contains(text(), 'period') or contains(text(), 'Game Winning Shot') or contains(text(), 'overtime') or contains(text(), 'Overtime')])[1]/ancestor::tr[1]/preceding-sibling::tr/td[{td}]/text()"
+
+
+EXPRESSIONS = {
+    # GamesByDate page
+    "game_links": "//table[@class='tblContent']/tr/td/a[starts-with(@href, 'java')]",
+    "game_link_href": ".//@href",
+    # ScheduleAndResults/Schedule page, result links of played games
+    "schedule_game_links": "//table[@class='tblContent']//a[contains(@href, '/Game/Events/')]",
+    # Texts of the cells of a game link's row, and of the closest
+    # header row above it, used to find the league of the game.
+    "game_row_texts": "ancestor::tr[1]/td//text()",
+    "game_header_texts": "ancestor::tr[1]/preceding-sibling::tr[th][1]/th//text()",
+    "next_page_url": "//div[@class='form-group btn-group']/a[2]/@href",
+    "next_page_text": "//div[@class='form-group btn-group']/a[2]/text()",
+    # Game/Events page, game summary table
+    "game_info": "(//table[@class='tblContent'])[1]",
+    "game_status": "//td[@class='tdInfoArea']/div[3]/text()",
+    "title": "//title/text()",
+    "teams": "//tr/th/h2/text()",
+    "date_time": ".//tr[2]/td[1]/h3/text()",
+    "league": ".//tr[2]/td[2]/h3/text()",
+    "arena": ".//tr[2]/td[3]/h3/b/text()",
+    "shots_total_team_1": stats_total_xpath(3, 2),
+    "shots_total_team_2": stats_total_xpath(3, 6),
+    "saves_total_team_1": stats_total_xpath(5, 2),
+    "saves_total_team_2": stats_total_xpath(5, 5),
+    "pim_total_team_1": stats_total_xpath(7, 2),
+    "pim_total_team_2": stats_total_xpath(7, 6),
+    "shots_by_period_team_1": stats_by_period_xpath(3, 3),
+    "shots_by_period_team_2": stats_by_period_xpath(3, 7),
+    "saves_by_period_team_1": stats_by_period_xpath(5, 3),
+    "saves_by_period_team_2": stats_by_period_xpath(5, 6),
+    "pim_by_period_team_1": stats_by_period_xpath(7, 3),
+    "pim_by_period_team_2": stats_by_period_xpath(7, 7),
+    "pp_time_team_1": stats_by_period_xpath(8, 3),
+    "pp_time_team_2": stats_by_period_xpath(8, 6),
+    "pp_perc_team_1": ".//tr[8]/td[2]/strong/text()",
+    "pp_perc_team_2": ".//tr[8]/td[5]/strong/text()",
+    "spectators": ".//td[@class='tdInfoArea']/div[4]/text()",
+    "score": "//td[@class='tdInfoArea']/div[1]/text()",
+    "score_by_period": "//td[@class='tdInfoArea']/div[2]/text()",
+    # Game/Events page, game events table
+    "events_table": "(//table[@class='tblContent'])[2]",
+    "goalies_teams": goalies_xpath(3),
+    "goalies_names": goalies_xpath(4),
+    "goalies_saves": goalies_xpath(5),
+    # Rows of the game events table, starting at the first period.
+    "event_rows": "(.//tr/th/h3[contains(text(), 'Overtime') or contains(text(), 'overtime') or contains(text(), '3rd period') or contains(text(), '2nd period') or contains(text(), '1st period') ])[1]/ancestor::node()/following-sibling::tr[not(.//th)]",
+    "event_time": ".//td[1]/text()",
+    "event_event": ".//td[2]/text()",
+    "event_team": ".//td[3]/text()",
+    "event_player": ".//td[4]/text()",
+    "event_assist_1": ".//td[4]/descendant-or-self::div[1]/text()",
+    "event_assist_2": ".//td[4]/descendant-or-self::div[2]/text()",
+    "event_details_1": ".//td[5]/descendant-or-self::text()[1]",
+    "event_details_2": ".//td[5]/descendant-or-self::text()[2]",
+    "text_nodes": "descendant-or-self::text()",
+    "shootout_rows": "((//table[@class='tblContent'])[2]/tr/th/h3[contains(text(), 'Game Winning Shots')])[1]/ancestor::tr[1]/following-sibling::tr/th/ancestor::tr[1]/preceding-sibling::tr/td/div[contains(text(), 'vs. goalie')]/ancestor::tr[1]",
+    "shootout_scored": ".//td[1]/text()",
+    "shootout_score": ".//td[2]/text()",
+    "shootout_team": ".//td[3]/text()",
+    "shootout_player": ".//td[4]//div[1]/text()",
+    "shootout_goalie": ".//td[4]//div[2]/text()",
+    # Game/LineUps page
+    "lineup_table": "(//table[@class='tblContent'])[2]",
+    "refs": "(.//table[@class='tblContent'])[1]//tr[1]/td[2]/text()",
+    "linesmen": "(.//table[@class='tblContent'])[1]//tr[2]/td[2]/text()",
+    "home_team_coaches": "(.//table[@class='tblContent'])[2]//tr[3]/td[2]/table/tr/td/text()",
+    "away_team_coaches": "(.//table[@class='tblContent'])[2]//tr[3]/following-sibling::tr[last()]//table/tr/td/text()",
+    "lineup_home": "((//table[@class='tblContent'])[4]//tr/th[contains(@class, 'tdSubTitle')])[2]/ancestor::tr[1]/preceding-sibling::tr/descendant::*[contains(@style, 'text-align')]/ancestor::tr[1]",
+    "lineup_away": "((//table[@class='tblContent'])[4]//tr/th[contains(@class, 'tdSubTitle')])[2]/ancestor::tr[1]/following-sibling::tr/td[contains(@style, 'text-align')]/ancestor::tr[1]",
+    "line_name": ".//*/strong/text()",
+    "line_players": ".//td/div/text()",
+    "starting_players": ".//*[contains(@class, 'red')]/text()",
+}
+
+XPATHS = {
+    name: etree.XPath(expression, smart_strings=False)
+    for name, expression in EXPRESSIONS.items()
+}
+
+
+def roots(selector):
+    # The lxml elements of a parsel Selector or SelectorList.
+    if isinstance(selector, SelectorList):
+        return [s.root for s in selector]
+    return [selector.root]
+
+
+def values(selector, xpath):
+    # Evaluate a precompiled XPath returning text or attributes. Gives
+    # the same result as selector.xpath(expression).getall().
+    result = []
+    for root in roots(selector):
+        value = xpath(root)
+        result += value if isinstance(value, list) else [value]
+    return [str(value) for value in result]
+
+
+def nodes(selector, xpath):
+    # Evaluate a precompiled XPath returning elements. Gives the same
+    # result as selector.xpath(expression).
+    return SelectorList(
+        Selector(root=element, type="html")
+        for root in roots(selector)
+        for element in xpath(root)
+    )
@@ -0,0 +1,59 @@
+# The pure lxml parsers (parsers.py) against the small saved game pages
+# in pages/. The events pages cover goals with +/- participation,
+# penalties, a penalty shot, a time out, overtime and a shootout.
+
+import os
+
+import pytest
+from scrapy.http import HtmlResponse
+
+from swehockey.parsers import parse_event_rows, parse_line, parse_shootout_row
+from swehockey.spiders.stats import StatsSpider
+from swehockey.xpaths import XPATHS, nodes
+
+PAGES = os.path.join(os.path.dirname(__file__), "pages")
+
+
+def page(name):
+    with open(os.path.join(PAGES, name), "rb") as f:
+        return HtmlResponse(url=f"file://{PAGES}/{name}", body=f.read())
+
+
+@pytest.mark.parametrize("name", ["events_regulation.html", "events_shootout.html"])
+def test_fast_event_parser_matches_loaders(name):
+    # The same check as the checkevents command: FAST_EVENT_PARSER
+    # must build exactly the items EventItemLoader builds.
+    events = nodes(page(name).selector, XPATHS["events_table"])
+    rows = nodes(events, XPATHS["event_rows"])
+    expected = [StatsSpider().load_game_event(row) for row in rows]
+    assert len(expected) == 9
+    assert parse_event_rows(row.root for row in rows) == expected
+
+
+def test_shootout_rows():
+    root = page("events_shootout.html").selector.root
+    shots = [parse_shootout_row(row) for row in XPATHS["shootout_rows"](root)]
+    assert [(s.scored, s.team, s.player, s.goalie) for s in shots] == [
+        ("Scored", "LHC", ["9", "Ek", "Erik"], ["30", "Johansson", "Johan"]),
+        ("Missed", "FHC", ["12", "Andersson", "Anders"], ["1", "Svensson", "Sven"]),
+        ("Missed", "LHC", ["4", "Dahl", "David"], ["30", "Johansson", "Johan"]),
+        ("Missed", "FHC", ["7", "Berg", "Bo"], ["1", "Svensson", "Sven"]),
+    ]
+
+
+def test_lines():
+    root = page("lineups.html").selector.root
+    home = [parse_line(row) for row in XPATHS["lineup_home"](root)]
+    away = [parse_line(row) for row in XPATHS["lineup_away"](root)]
+    assert [(line.line_name, line.players) for line in home] == [
+        ("Goalies", [["30", "Johansson", "Johan"], ["35", "Backup", "Bert"]]),
+        (
+            "1st Line",
+            [["7", "Berg", "Bo"], ["12", "Andersson", "Anders"], ["22", "Carlsson", "Carl"]],
+        ),
+        ("", [["8", "Extra", "Eddie"]]),
+    ]
+    assert [(line.line_name, line.players) for line in away] == [
+        ("Goalies", [["1", "Svensson", "Sven"]]),
+        ("1st Line", [["4", "Dahl", "David"], ["9", "Ek", "Erik"]]),
+    ]